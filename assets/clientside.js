@@ -0,0 +1,252 @@
+/*
+ * Clientside callbacks of trees_of_nyc.py
+ *
+ * Typed arrays are sent as {dtype, bdata} (base64), see encode_array() in
+ * trees_of_nyc.py. In client mode (TREES_CLIENT_MODE=1) the filtering, the
+ * checklist labels, the map and the statistics run here, see
+ * make_client_data().
+ */
+
+(function () {
+
+    var types = {f4: Float32Array, f8: Float64Array, i4: Int32Array, i2: Int16Array,
+                 i1: Int8Array, u1: Uint8Array};
+
+    // decode all {dtype, bdata} objects to javascript typed arrays
+    function decode(value) {
+        if (Array.isArray(value)) {
+            return value.map(decode);
+        }
+        if (value === null || typeof value !== 'object') {
+            return value;
+        }
+        if (typeof value.bdata === 'string' && types[value.dtype]) {
+            var binary = atob(value.bdata);
+            var bytes = new Uint8Array(binary.length);
+            for (var i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            return new types[value.dtype](bytes.buffer);
+        }
+        var result = {};
+        for (var key in value) {
+            result[key] = decode(value[key]);
+        }
+        return result;
+    }
+
+    // the client data is decoded once, not on every filter change
+    var decoded = {source: null, data: null};
+
+    function clientData(data) {
+        if (decoded.source !== data) {
+            decoded = {source: data, data: decode(data)};
+        }
+        return decoded.data;
+    }
+
+    // decoded traces and layout of the last figure. A figure patched by
+    // update_graph_mapbox keeps the objects of its unchanged traces, they
+    // are not decoded again and plotly only draws the added traces
+    var figureCache = {traces: {}, layout: null};
+
+    function decodeCached(source, cached) {
+        return cached && cached.source === source ? cached : {source: source, decoded: decode(source)};
+    }
+
+    function indexes(names, values) {
+        var selected = new Uint8Array(names.length);
+        (values || []).forEach(function (value) {
+            var idx = names.indexOf(value);
+            if (idx >= 0) {
+                selected[idx] = 1;
+            }
+        });
+        return selected;
+    }
+
+    function options(names, counts) {
+        return names.map(function (name, idx) {
+            return {label: name + ' (' + counts[idx] + ')', value: name};
+        });
+    }
+
+    // one decimal, halves to even as round() of pandas
+    function round1(value) {
+        var scaled = value * 10;
+        return (Math.abs(scaled % 1) === 0.5 ? 2 * Math.round(scaled / 2) : Math.round(scaled)) / 10;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        trees: {
+
+            decode_figure: function (figure) {
+                if (!figure) {
+                    return window.dash_clientside.no_update;
+                }
+                var traces = {};
+                var data = (figure.data || []).map(function (trace, idx) {
+                    var uid = trace.uid !== undefined ? trace.uid : '#' + idx;
+                    traces[uid] = decodeCached(trace, figureCache.traces[uid]);
+                    return traces[uid].decoded;
+                });
+                figureCache = {traces: traces, layout: decodeCached(figure.layout, figureCache.layout)};
+                return Object.assign({}, figure, {data: data, layout: figureCache.layout.decoded});
+            },
+
+            // same results as update_filtered_data, update_borough_options,
+            // update_health_status_options and update_graph_mapbox
+            filter_trees: function (borough, health, data) {
+                var no_update = window.dash_clientside.no_update;
+                if (!data || health === null || health === undefined) {
+                    return [no_update, no_update, no_update, no_update];
+                }
+                data = clientData(data);
+                var nb = data.boroughs.length, nh = data.health.length, n = data.tree_id.length;
+                var boroughSelected = indexes(data.boroughs, borough);
+                var healthSelected = indexes(data.health, health);
+
+                // trees per borough and health status
+                var counts = new Int32Array(nb * nh);
+                for (var i = 0; i < n; i++) {
+                    if (data.borough[i] >= 0 && data.health_code[i] >= 0) {
+                        counts[data.borough[i] * nh + data.health_code[i]]++;
+                    }
+                }
+
+                // checklist labels, counts given the other selection
+                var boroughCounts = new Array(nb).fill(0), healthCounts = new Array(nh).fill(0);
+                for (var b = 0; b < nb; b++) {
+                    for (var h = 0; h < nh; h++) {
+                        if (healthSelected[h]) {
+                            boroughCounts[b] += counts[b * nh + h];
+                        }
+                        if (boroughSelected[b]) {
+                            healthCounts[h] += counts[b * nh + h];
+                        }
+                    }
+                }
+
+                // one trace per health status and borough as in
+                // create_tree_trace(), positions of the trees of each slice
+                var start = new Int32Array(nb * nh + 1);
+                for (var s = 0; s < nb * nh; s++) {
+                    start[s + 1] = start[s] + counts[s];
+                }
+                var fill = start.slice(0, nb * nh), order = new Int32Array(n);
+                for (i = 0; i < n; i++) {
+                    if (data.borough[i] >= 0 && data.health_code[i] >= 0) {
+                        order[fill[data.borough[i] * nh + data.health_code[i]]++] = i;
+                    }
+                }
+
+                var traces = [];
+                for (h = 0; h < nh; h++) {
+                    for (b = 0; b < nb; b++) {
+                        var slice = b * nh + h;
+                        if (!healthSelected[h] || !boroughSelected[b] || counts[slice] === 0) {
+                            continue;
+                        }
+                        var positions = order.subarray(start[slice], start[slice + 1]);
+                        var lat = new Float32Array(positions.length), lon = new Float32Array(positions.length);
+                        var tree_id = new Int32Array(positions.length), size = new Uint8Array(positions.length);
+                        for (i = 0; i < positions.length; i++) {
+                            lat[i] = data.lat[positions[i]];
+                            lon[i] = data.lon[positions[i]];
+                            tree_id[i] = data.tree_id[positions[i]];
+                            size[i] = data.size[positions[i]];
+                        }
+                        traces.push({type: 'scattermapbox', uid: data.boroughs[b] + '|' + data.health[h],
+                                     name: data.boroughs[b], legendgroup: data.health[h],
+                                     legendgrouptitle: {text: data.health[h]},
+                                     lat: lat, lon: lon, customdata: tree_id,
+                                     marker: {color: data.colors[h], size: size, sizemode: 'area',
+                                              sizeref: data.sizeref},
+                                     mode: 'markers', hoverinfo: 'none'});
+                    }
+                }
+                if (traces.length === 0) {
+                    traces.push({type: 'scattermapbox', lat: [], lon: [], mode: 'markers'});
+                }
+
+                // sorted as in make_filter_state()
+                var boroughSorted = (borough || []).slice().sort(), healthSorted = (health || []).slice().sort();
+                var filterState = {key: 'client:' + JSON.stringify([boroughSorted, healthSorted]),
+                                   borough: boroughSorted, health: healthSorted};
+
+                return [filterState, {data: traces, layout: data.layout},
+                        options(data.boroughs, boroughCounts), options(data.health, healthCounts)];
+            },
+
+            // same results as update_statistics, the statistics cube of the
+            // dimension sliced by the filter as in StatsCube.statistics()
+            statistics: function (filterState, dimension, measure, data) {
+                if (!data || !filterState) {
+                    return [[], [], {}];
+                }
+                data = clientData(data);
+                var stats = data.stats, cube = stats.cubes[dimension];
+                if (!cube) {
+                    return [[], [], {}];
+                }
+                var nv = cube.values.length, nh = data.health.length;
+                var boroughSelected = indexes(data.boroughs, filterState.borough);
+                var healthSelected = indexes(data.health, filterState.health);
+
+                var trees = new Float64Array(nv), dbhSum = new Float64Array(nv), dbhCount = new Float64Array(nv);
+                var byHealth = new Float64Array(nv * nh);
+                for (var i = 0; i < cube.value.length; i++) {
+                    if (!boroughSelected[cube.borough[i]] || !healthSelected[cube.health[i]]) {
+                        continue;
+                    }
+                    var v = cube.value[i];
+                    trees[v] += cube.trees[i];
+                    dbhSum[v] += cube.dbh_sum[i];
+                    dbhCount[v] += cube.dbh_count[i];
+                    byHealth[v * nh + cube.health[i]] += cube.trees[i];
+                }
+
+                var name = stats.labels[dimension];
+                var records = [];
+                for (v = 0; v < nv; v++) {
+                    if (trees[v] === 0) {
+                        continue;
+                    }
+                    var record = {};
+                    record[name] = cube.values[v];
+                    record.Trees = trees[v];
+                    stats.health_order.forEach(function (val) {
+                        var h = data.health.indexOf(val);
+                        record[val] = h >= 0 ? byHealth[v * nh + h] : 0;
+                    });
+                    ['Poor', 'Dead', 'Stump'].forEach(function (val) {
+                        record['% ' + val] = round1(100 * record[val] / trees[v]);
+                    });
+                    record['Mean diameter'] = dbhCount[v] > 0 ? round1(dbhSum[v] / dbhCount[v]) : null;
+                    records.push(record);
+                }
+                var columns = [name, 'Trees'].concat(stats.health_order, ['% Poor', '% Dead', '% Stump',
+                                                                         'Mean diameter']);
+
+                // highest values, ratios of very small groups are left out
+                var ranked = records.filter(function (record) {
+                    return record[measure] !== null && (measure === 'Trees' || record.Trees >= stats.min_trees);
+                });
+                ranked.sort(function (a, b) {
+                    return b[measure] - a[measure];
+                });
+                ranked = ranked.slice(0, stats.bar_count).reverse();
+
+                var layout = Object.assign({}, stats.layout, {
+                    height: Math.max(300, 20 * ranked.length + 100),
+                    xaxis: Object.assign({}, stats.layout.xaxis, {title: {text: measure}})});
+                var bars = {type: 'bar', orientation: 'h',
+                            x: ranked.map(function (record) { return record[measure]; }),
+                            y: ranked.map(function (record) { return record[name]; })};
+
+                return [columns.map(function (val) { return {name: val, id: val}; }), records,
+                        {data: [bars], layout: layout}];
+            }
+        }
+    });
+})();
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of trees_of_nyc.py on synthetic census data.
+
+The census is generated offline (see socrata_stub.py) with the same columns
+as the Socrata records consumed by get_data(). For each data set size the
+following steps are timed and their peak memory is measured:
+
+    - cleaning of the downloaded pages (clean_data, concat_frames)
+    - building of the derived indexes (init_data)
+    - update_filtered_data (also with a species selection),
+      update_graph_mapbox, create_mapbox_figure
+    - update_borough_options, update_health_status_options
+    - get_single_tree_data
+    - each export (all, filtered, graph_select as csv and xlsx)
+
+Results are written as JSON. Compared to a baseline, every step which got
+slower or uses more memory than the tolerance allows is flagged as
+regression, and the exit code is 1:
+
+    python benchmark.py --sizes 20000 200000 --save benchmark_baseline.json
+    python benchmark.py --sizes 20000 200000 --baseline benchmark_baseline.json
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+
+import socrata_stub
+
+
+def measure(func, setup=None, repeat=3):
+
+    ## best wall time of repeat runs, peak memory from an extra traced run
+    ## (tracing slows down the run)
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def load_synthetic(app, rows):
+
+    ## clean the census page by page as get_data() does, the raw pages are
+    ## generated outside of the measurement. As in measure(), each page is
+    ## timed untraced and its peak memory taken from an extra traced run on
+    ## a copy of the page
+    pages, clean_time, clean_peak = [], 0.0, 0
+    for offset in range(0, rows, app.page_size):
+        raw = socrata_stub.make_census(min(app.page_size, rows - offset), seed=offset, offset=offset)
+        traced_raw = raw.copy()
+        gc.collect()
+        start = time.perf_counter()
+        pages.append(app.clean_data(raw))
+        clean_time += time.perf_counter() - start
+        del raw
+
+        gc.collect()
+        tracemalloc.start()
+        app.clean_data(traced_raw)
+        clean_peak = max(clean_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del traced_raw
+
+    start = time.perf_counter()
+    df = app.concat_frames(pages)
+    concat_time = time.perf_counter() - start
+
+    return df, {'time': clean_time + concat_time, 'peak_memory': clean_peak}
+
+
+def consume(client, url):
+    ## read the streamed response chunk by chunk. The job of an XLSX export is
+    ## polled at its location until the file is ready
+    response = client.get(url, buffered=False)
+    while response.status_code == 202:
+        response.close()
+        time.sleep(0.01)
+        response = client.get(response.headers['Location'], buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    assert response.status_code == 200, (url, response.status_code)
+    return size
+
+
+def run_size(app, rows, repeat, xlsx_max_rows):
+
+    results = {}
+    df, results['clean_data'] = load_synthetic(app, rows)
+    results['init_data'] = measure(lambda: app.init_data(df, rows), repeat=1)
+
+    borough = ['Brooklyn']
+    health = list(app.tree_data.health_status)
+    clear_filter = app.filter_cache.clear
+
+    results['update_filtered_data'] = measure(
+        lambda: app.update_filtered_data(borough, health), clear_filter, repeat)
+
+    species = app.tree_data.species_index.search('', 3)
+    results['update_filtered_data_species'] = measure(
+        lambda: app.update_filtered_data(borough, health, None, species), clear_filter, repeat)
+
+    filter_state = app.update_filtered_data(borough, health)
+    df_filtered = app.resolve_filter(app.tree_data, filter_state)['filtered']
+
+    zoomed_out = {'zoom': app.map_zoom, 'level': app.zoom_level(app.map_zoom)}
+    zoomed_in = app.update_map_view({'mapbox.zoom': 15, 'mapbox.center': {'lat': 40.65, 'lon': -73.95}},
+                                    zoomed_out)
+    results['update_graph_mapbox_grid'] = measure(
+        lambda: app.update_graph_mapbox(filter_state, zoomed_out), repeat=repeat)
+    results['update_graph_mapbox_points'] = measure(
+        lambda: app.update_graph_mapbox(filter_state, zoomed_in), repeat=repeat)
+    results['create_mapbox_figure'] = measure(
+        lambda: app.create_mapbox_figure(df_filtered), repeat=1)
+
+    results['update_borough_options'] = measure(
+        lambda: app.update_borough_options(filter_state), repeat=repeat)
+    results['update_health_status_options'] = measure(
+        lambda: app.update_health_status_options(filter_state), repeat=repeat)
+
+    tree_ids = df['tree_id'].sample(100, random_state=0).tolist()
+    results['get_single_tree_data'] = measure(
+        lambda: [app.get_single_tree_data({'points': [{'customdata': [tree_id]}]}) for tree_id in tree_ids],
+        app.tree_cache.clear, repeat)
+
+    lasso = {'lassoPoints': {'mapbox': [[-73.99, 40.63], [-73.92, 40.62], [-73.90, 40.68], [-73.97, 40.69]]}}
+    selection, _ = app.update_user_selected_data(lasso, filter_state)
+
+    ## xlsx exports run as jobs, finished results must not be reused
+    clear_jobs = lambda: shutil.rmtree(app.job_queue.path, ignore_errors=True)
+
+    client = app.app.server.test_client()
+    for scope, params in [('all', {}),
+                          ('filtered', {'filter_state': filter_state}),
+                          ('graph_select', {'selection': selection})]:
+        for fmt in ['csv', 'xlsx']:
+            if fmt == 'xlsx' and rows > xlsx_max_rows and scope != 'graph_select':
+                continue
+            url = app.export_url(scope, fmt, **params)
+            results['export_{}_{}'.format(scope, fmt)] = measure(
+                lambda: consume(client, url), clear_jobs, repeat=1 if fmt == 'xlsx' else repeat)
+
+    print_results({rows: results})
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+
+    regressions = []
+    for size, steps in results.items():
+        for step, result in steps.items():
+            base = baseline.get(size, {}).get(step)
+            if not base:
+                continue
+            for metric in ('time', 'peak_memory'):
+                if result[metric] > base[metric] * (1 + tolerance):
+                    regressions.append('{} rows, {}: {} {:.4g} -> {:.4g}'.format(
+                        size, step, metric, base[metric], result[metric]))
+    return regressions
+
+
+def print_results(results):
+    for size, steps in results.items():
+        print('\n{} rows'.format(size))
+        for step, result in steps.items():
+            print('  {:32s} {:10.4f} s {:10.1f} MB'.format(step, result['time'], result['peak_memory'] / 1e6))
+    sys.stdout.flush()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20000, 200000, 700000, 2000000],
+                        help='number of synthetic trees')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs, the best one counts')
+    parser.add_argument('--xlsx-max-rows', type=int, default=20000,
+                        help='skip the slow xlsx exports of all and filtered data above this size')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='flag regressions against this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative increase of time and memory')
+    parser.add_argument('--save', metavar='BASELINE', help='store the results as new baseline')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+
+    ## import the app against a tiny stand-in data set, the benchmark data is
+    ## set with init_data(). The cache is written to a temporary directory
+    server = socrata_stub.start_server(rows=1000, port=0)
+    os.environ['TREES_DATASOURCE'] = 'http://localhost:{}'.format(server.server_address[1])
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    import trees_of_nyc as app
+    app.start_loading()
+    app.wait_for_data()
+    os.chdir(cwd)
+    server.shutdown()
+
+    results = {}
+    for rows in args.sizes:
+        results[str(rows)] = run_size(app, rows, args.repeat, args.xlsx_max_rows)
+
+    report = {'meta': {'python': platform.python_version(), 'pandas': pd.__version__,
+                       'numpy': np.__version__, 'machine': platform.machine(),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results': results}
+    for path in filter(None, [args.output, args.save]):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('\nRegressions against {}:'.format(args.baseline))
+            print('\n'.join('  ' + val for val in regressions))
+            sys.exit(1)
+        print('\nNo regressions against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings for trees_of_nyc.py, read from the current directory:
+
+    gunicorn -w 4 -b 0.0.0.0:8050 trees_of_nyc:server
+"""
+
+
+def post_fork(server, worker):
+    ## every worker loads the data in a background thread right away, not
+    ## with its first request. Also works with --preload: importing the
+    ## module in the master process doesn't load anything. The messages of
+    ## the app go to the root logger of the worker, gunicorn's own loggers
+    ## are not touched
+    import logging
+    import trees_of_nyc
+    logging.basicConfig(level=logging.INFO, format=trees_of_nyc.log_format)
+    trees_of_nyc.start_loading()
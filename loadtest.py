@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of trees_of_nyc.py with concurrent browser sessions.
+
+The app is started in a subprocess against the synthetic census of
+socrata_stub.py, no network access is needed. Each session loads the page
+and then replays what a browser posts to /_dash-update-component for random
+user actions, with a think time in between:
+
+    - checking and unchecking boroughs and health status
+    - zooming the map, switching to density mode and back
+    - hovering and clicking trees on the map
+    - lasso selections on the map
+    - searching and selecting species, changing the statistics
+    - export clicks: the export job is polled until the file is ready,
+      then it is downloaded
+
+The callbacks are found in /_dash-dependencies and run like the browser
+does: every callback with a changed input is posted, then the callbacks of
+its outputs. The throughput, the p50/p95/p99 latency per callback (named by
+its outputs) and the memory (RSS of the app with all its child processes,
+sampled from /proc) over time are reported. Results are written as JSON, a
+baseline from an earlier run is shown side by side:
+
+    python loadtest.py --sessions 20 --duration 60 --save loadtest_baseline.json
+    python loadtest.py --sessions 20 --duration 60 --baseline loadtest_baseline.json
+
+Other ways to serve the app can be tested with --command, {port} is
+replaced with the port of the test, e.g.:
+
+    python loadtest.py --command "gunicorn -w 4 -b 127.0.0.1:{port} trees_of_nyc:server"
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import requests
+
+import socrata_stub
+
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(command, port, datasource, workdir):
+
+    ## the app writes its cache, jobs and log to workdir
+    env = dict(os.environ, TREES_DATASOURCE=datasource,
+               PYTHONPATH=os.pathsep.join(filter(None, [app_dir, os.environ.get('PYTHONPATH')])))
+    if command:
+        args = shlex.split(command.format(port=port))
+    else:
+        args = [sys.executable, '-c', 'import trees_of_nyc as app; app.start_loading(); '
+                'app.server.run(host="127.0.0.1", port={}, threaded=True)'.format(port)]
+    with open(os.path.join(workdir, 'app.log'), 'w') as log:
+        return subprocess.Popen(args, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url, process, timeout):
+
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError('The app exited with code {}'.format(process.returncode))
+        try:
+            response = requests.get(url + '/api/status', timeout=5)
+            if response.status_code == 200:
+                return response.json()
+            if response.json().get('status') == 'failed':
+                raise RuntimeError('The app could not load the data: {}'.format(response.json().get('error')))
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('The app was not ready after {} s'.format(timeout))
+
+
+def process_tree(pid):
+
+    ## pid and all its descendants, e.g. gunicorn workers and job processes
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    pids, todo = [], [pid]
+    while todo:
+        pids.append(todo.pop())
+        todo.extend(children.get(pids[-1], []))
+    return pids
+
+
+def tree_rss(pid):
+    ## resident memory of the process tree in bytes
+    total = 0
+    for val in process_tree(pid):
+        try:
+            with open('/proc/{}/status'.format(val)) as f:
+                total += sum(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        except OSError:
+            pass
+    return total
+
+
+class MemorySampler(threading.Thread):
+
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = time.time()
+        while True:
+            self.samples.append((round(time.time() - start, 1), tree_rss(self.pid)))
+            if self.stopped.wait(self.interval):
+                break
+
+
+class Recorder:
+
+    ## latencies and errors per callback of all sessions
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, latency, ok=True):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def layout_values(component, values):
+
+    ## initial property values of all components with an id
+    if isinstance(component, list):
+        for val in component:
+            layout_values(val, values)
+    elif isinstance(component, dict) and 'props' in component:
+        props = component['props']
+        if 'id' in props:
+            for prop, value in props.items():
+                if prop not in ('id', 'children'):
+                    values['{}.{}'.format(props['id'], prop)] = value
+        layout_values(props.get('children'), values)
+    return values
+
+
+def split_outputs(output):
+    ## 'id.prop' or '..id1.prop1...id2.prop2..' as list of 'id.prop'
+    return output.strip('.').split('...') if output.startswith('..') else [output]
+
+
+class Session:
+
+    def __init__(self, url, recorder, tree_ids, rng, args):
+        self.url = url
+        self.recorder = recorder
+        self.tree_ids = tree_ids
+        self.rng = rng
+        self.args = args
+        self.http = requests.Session()
+        self.values = {}
+        self.callbacks = []
+
+    def get(self, path, name):
+        start = time.perf_counter()
+        try:
+            response = self.http.get(self.url + path, timeout=self.args.timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.add(name, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    def load_page(self):
+
+        ## what the browser loads first, then the initial callbacks
+        self.get('/', 'GET /')
+        layout = self.get('/_dash-layout', 'GET /_dash-layout')
+        dependencies = self.get('/_dash-dependencies', 'GET /_dash-dependencies')
+        if layout is None or dependencies is None:
+            raise RuntimeError('Page could not be loaded')
+        self.values = layout_values(layout.json(), {})
+        ## clientside callbacks run in the browser, see emulation below
+        self.callbacks = [dep for dep in dependencies.json() if not dep.get('clientside_function')]
+        initial = [dep for dep in self.callbacks if not dep.get('prevent_initial_call')]
+        self.run_callbacks(initial, [])
+
+    def post(self, dep, changed):
+
+        outputs = [dict(zip(['id', 'property'], val.split('.', 1))) for val in split_outputs(dep['output'])]
+        props = lambda items: [dict(val, value=self.values.get('{}.{}'.format(val['id'], val['property'])))
+                               for val in items]
+        body = {'output': dep['output'],
+                'outputs': outputs if dep['output'].startswith('..') else outputs[0],
+                'inputs': props(dep['inputs']), 'state': props(dep['state']),
+                'changedPropIds': changed}
+
+        name = '+'.join(split_outputs(dep['output']))
+        start = time.perf_counter()
+        try:
+            response = self.http.post(self.url + '/_dash-update-component', json=body, timeout=self.args.timeout)
+            ok = response.status_code in (200, 204)
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.add(name, time.perf_counter() - start, ok)
+
+        ## 204: PreventUpdate, no output changed
+        if not ok or response.status_code == 204:
+            return []
+        changed_outputs = []
+        for component, props in response.json()['response'].items():
+            for prop, value in props.items():
+                self.values['{}.{}'.format(component, prop)] = value
+                changed_outputs.append('{}.{}'.format(component, prop))
+        return changed_outputs
+
+    def run_callbacks(self, callbacks, changed):
+        ## callbacks in rounds: the callbacks of the outputs changed in a
+        ## round run in the next round, as in the browser
+        while callbacks:
+            changed_next = []
+            for dep in callbacks:
+                inputs = ['{}.{}'.format(val['id'], val['property']) for val in dep['inputs']]
+                changed_next += self.post(dep, [val for val in changed if val in inputs])
+            changed = self.emulate_clientside(changed_next)
+            callbacks = [dep for dep in self.callbacks
+                         if any('{}.{}'.format(val['id'], val['property']) in changed for val in dep['inputs'])]
+
+    def emulate_clientside(self, changed):
+        ## the selection geometry is sent by a clientside callback
+        if 'graph_mapbox.selectedData' in changed:
+            selected_data = self.values['graph_mapbox.selectedData'] or {}
+            self.values['store_selection_geometry.data'] = {key: selected_data.get(key)
+                                                            for key in ('range', 'lassoPoints')}
+            changed = changed + ['store_selection_geometry.data']
+        return changed
+
+    def set(self, **props):
+        ## user input: set the properties and run the callbacks
+        changed = []
+        for key, value in props.items():
+            prop = key.replace('__', '.')
+            self.values[prop] = value
+            changed.append(prop)
+        changed = self.emulate_clientside(changed)
+        self.run_callbacks([dep for dep in self.callbacks
+                            if any('{}.{}'.format(val['id'], val['property']) in changed for val in dep['inputs'])],
+                           changed)
+        ## the density map and species statistics are polled until their
+        ## jobs are done, as in the browser
+        if not any(prop.endswith('.n_intervals') for prop in changed):
+            self.poll('interval_map_job')
+            self.poll('interval_stats_job')
+
+    def poll(self, interval):
+        ## the interval fires until its callback disables it
+        deadline = time.time() + self.args.timeout
+        while self.values.get(interval + '.disabled') is False and time.time() < deadline:
+            time.sleep(self.args.poll)
+            self.set(**{interval + '__n_intervals': (self.values.get(interval + '.n_intervals') or 0) + 1})
+
+    def option(self, component):
+        ## a random value of the options of a checklist or radio items
+        return self.rng.choice(self.values.get(component + '.options') or [{'value': None}])['value']
+
+    def toggle(self, component):
+        selected = list(self.values.get(component + '.value') or [])
+        val = self.option(component)
+        if val in selected and len(selected) > 1:
+            selected.remove(val)
+        elif val not in selected:
+            selected.append(val)
+        self.set(**{component + '__value': selected})
+
+    def random_point(self):
+        ## a point in one of the boroughs
+        lat_min, lat_max, lon_min, lon_max = self.rng.choice(list(socrata_stub.boroughs.values()))[:4]
+        return (lat_min + self.rng.random() * (lat_max - lat_min),
+                lon_min + self.rng.random() * (lon_max - lon_min))
+
+    def zoom(self):
+        zoom = self.rng.choice([10, 11, 12, 13, 14, 15, 16])
+        lat, lon = self.random_point()
+        self.set(graph_mapbox__relayoutData={'mapbox.zoom': zoom, 'mapbox.center': {'lat': lat, 'lon': lon}})
+
+    def lasso(self):
+        lat, lon = self.random_point()
+        size = 0.005 + self.rng.random() * 0.03
+        polygon = [[lon - size, lat - size], [lon + size, lat - size], [lon + size, lat + size], [lon - size, lat + size]]
+        self.set(graph_mapbox__selectedData={'lassoPoints': {'mapbox': polygon}})
+
+    def species(self):
+        self.set(dropdown_species__search_value=self.rng.choice(['oak', 'map', 'pla', 'lin', 'acer', 'elm']))
+        options = self.values.get('dropdown_species.options') or []
+        value = [self.rng.choice(options)['value']] if options and self.rng.random() < 0.7 else []
+        self.set(dropdown_species__search_value='', dropdown_species__value=value)
+
+    def export(self):
+
+        ## click, poll the job until the file is ready, download it
+        button = self.rng.choice(['btn_filtered_csv'] * 4 + ['btn_graph_select_csv'] * 2 + ['btn_all_csv',
+                                  'btn_filtered_xlsx', 'btn_graph_select_xlsx'])
+        self.set(**{button + '__n_clicks': (self.values.get(button + '.n_clicks') or 0) + 1})
+        self.poll('interval_jobs')
+        jobs = self.values.get('store_export_jobs.data') or []
+        if jobs:
+            self.get('/jobs/' + jobs[-1]['key'], 'GET /jobs')
+
+    def act(self):
+
+        actions = [(30, lambda: self.toggle('checklist_borough')),
+                   (15, lambda: self.toggle('checklist_health')),
+                   (15, self.zoom),
+                   (10, lambda: self.set(graph_mapbox__hoverData={'points': [{'customdata': self.rng.choice(self.tree_ids)}]})),
+                   (10, lambda: self.set(graph_mapbox__clickData={'points': [{'customdata': self.rng.choice(self.tree_ids)}]})),
+                   (6, self.lasso),
+                   (6, self.species),
+                   (4, lambda: self.set(radio_stats_dimension__value=self.option('radio_stats_dimension'))),
+                   (2, lambda: self.set(radio_map_mode__value=self.option('radio_map_mode'))),
+                   (self.args.export_weight, self.export)]
+        weights = [val for val, _ in actions]
+        self.rng.choices([action for _, action in actions], weights)[0]()
+
+    def run(self, stop):
+        try:
+            self.load_page()
+            while not stop.is_set():
+                self.act()
+                stop.wait(self.rng.uniform(0.5, 1.5) * self.args.think)
+        except Exception as e:
+            self.recorder.add('session error: {}'.format(type(e).__name__), 0, False)
+
+
+def summarize(recorder, duration, samples, args):
+
+    callbacks = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        values = np.array(latencies) * 1000
+        callbacks[name] = {'count': len(values), 'errors': recorder.errors.get(name, 0),
+                           'p50_ms': float(np.percentile(values, 50)),
+                           'p95_ms': float(np.percentile(values, 95)),
+                           'p99_ms': float(np.percentile(values, 99))}
+
+    requests_total = sum(val['count'] for val in callbacks.values())
+    rss = [val for _, val in samples]
+    return {'sessions': args.sessions, 'duration': duration, 'requests': requests_total,
+            'throughput': requests_total / duration,
+            'errors': sum(val['errors'] for val in callbacks.values()),
+            'callbacks': callbacks,
+            'memory': {'start': rss[0] if rss else None, 'peak': max(rss) if rss else None,
+                       'end': rss[-1] if rss else None, 'samples': samples}}
+
+
+def print_results(results, baseline=None):
+
+    baseline = baseline or {}
+    print('\n{} sessions, {:.1f} s: {} requests, {:.1f} requests/s, {} errors'.format(
+        results['sessions'], results['duration'], results['requests'], results['throughput'], results['errors']))
+    if baseline:
+        print('baseline: {} requests, {:.1f} requests/s, {} errors'.format(
+            baseline['requests'], baseline['throughput'], baseline['errors']))
+
+    print('\n  {:64s} {:>6s} {:>9s} {:>9s} {:>9s} {:>6s}'.format('callback', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for name, val in results['callbacks'].items():
+        print('  {:64s} {:6d} {:9.1f} {:9.1f} {:9.1f} {:6d}'.format(
+            name[:64], val['count'], val['p50_ms'], val['p95_ms'], val['p99_ms'], val['errors']))
+        base = baseline.get('callbacks', {}).get(name)
+        if base:
+            print('  {:>64s} {:6d} {:9.1f} {:9.1f} {:9.1f} {:6d}'.format(
+                'baseline', base['count'], base['p50_ms'], base['p95_ms'], base['p99_ms'], base['errors']))
+
+    memory = results['memory']
+    if memory['samples']:
+        print('\nMemory (RSS of the app and its child processes): start {:.0f} MB, peak {:.0f} MB, '
+              'end {:.0f} MB, growth {:+.0f} MB'.format(memory['start'] / 1e6, memory['peak'] / 1e6,
+                                                        memory['end'] / 1e6, (memory['end'] - memory['start']) / 1e6))
+        step = max(1, len(memory['samples']) // 10)
+        print('  ' + ', '.join('{:.0f} s: {:.0f} MB'.format(sec, rss / 1e6) for sec, rss in memory['samples'][::step]))
+        if baseline.get('memory', {}).get('samples'):
+            base = baseline['memory']
+            print('  baseline: start {:.0f} MB, peak {:.0f} MB, end {:.0f} MB'.format(
+                base['start'] / 1e6, base['peak'] / 1e6, base['end'] / 1e6))
+    sys.stdout.flush()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10, help='concurrent browser sessions')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load after the ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds until all sessions are started')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='mean seconds between the actions of a session, 0 for maximum load')
+    parser.add_argument('--export-weight', type=float, default=2,
+                        help='weight of export clicks among the actions (toggles: 45)')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between polls of a job')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds per request')
+    parser.add_argument('--rows', type=int, default=50000, help='synthetic trees of the stub data source')
+    parser.add_argument('--command', help='command serving the app on {port}, default: the Flask server')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='seconds between memory samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest_results.json')
+    parser.add_argument('--baseline', help='show the results of this file side by side')
+    parser.add_argument('--save', metavar='BASELINE', help='store the results as new baseline')
+    args = parser.parse_args()
+
+    server = socrata_stub.start_server(rows=args.rows, port=0)
+    workdir = tempfile.mkdtemp(prefix='trees_loadtest_')
+    port = free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    process = start_app(args.command, port, 'http://localhost:{}'.format(server.server_address[1]), workdir)
+    print('App log: {}'.format(os.path.join(workdir, 'app.log')))
+
+    try:
+        status = wait_ready(url, process, args.timeout)
+        print('App ready with {} trees'.format(status['trees']))
+
+        ## trees loaded by the app: the first of the census by tree_id
+        tree_ids = sorted(int(val) for val in server.census['tree_id'])[:status['trees']]
+
+        sampler = MemorySampler(process.pid, args.sample_interval)
+        if os.path.isdir('/proc'):
+            sampler.start()
+
+        recorder = Recorder()
+        stop = threading.Event()
+        threads = []
+        start = time.time()
+        for idx in range(args.sessions):
+            session = Session(url, recorder, tree_ids, random.Random(args.seed + idx), args)
+            threads.append(threading.Thread(target=session.run, args=(stop,), daemon=True))
+            threads[-1].start()
+            time.sleep(args.ramp_up / max(args.sessions, 1))
+        time.sleep(max(0, args.duration - (time.time() - start - args.ramp_up)))
+        stop.set()
+        for thread in threads:
+            thread.join(args.timeout)
+        duration = time.time() - start
+
+        sampler.stopped.set()
+        results = summarize(recorder, duration, sampler.samples, args)
+
+    finally:
+        for pid in reversed(process_tree(process.pid)) if os.path.isdir('/proc') else [process.pid]:
+            try:
+                os.kill(pid, 15)
+            except OSError:
+                pass
+        process.wait(30)
+        server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    report = {'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                       'command': args.command, 'rows': args.rows, 'think': args.think,
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'results': results}
+    for path in filter(None, [args.output, args.save]):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
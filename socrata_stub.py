@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Socrata API of the NYC OpenData server.
+
+Serves a synthetic 2015 Street Tree Census with the same columns as the
+original data set (uvpi-gqnh), so that trees_of_nyc.py can be run and tested
+without network access:
+
+    python socrata_stub.py --rows 20000 --port 8051
+    TREES_DATASOURCE=http://localhost:8051 python trees_of_nyc.py
+
+Only the parts of SoQL used by trees_of_nyc.py are supported: $select with
+COUNT(*) or a list of columns, $order, $limit, $offset, system fields and $where on :updated_at.
+"""
+
+import re
+import json
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+
+
+## rough bounding boxes (lat_min, lat_max, lon_min, lon_max) and share of
+## trees for each borough
+boroughs = {
+    'Queens':        (40.58, 40.79, -73.94, -73.73, 0.37, 4, 'QN'),
+    'Brooklyn':      (40.58, 40.73, -74.03, -73.86, 0.26, 3, 'BK'),
+    'Staten Island': (40.50, 40.64, -74.25, -74.06, 0.15, 5, 'SI'),
+    'Bronx':         (40.80, 40.91, -73.93, -73.77, 0.12, 2, 'BX'),
+    'Manhattan':     (40.70, 40.87, -74.02, -73.91, 0.10, 1, 'MN'),
+}
+
+species = [
+    ('Platanus x acerifolia', 'London planetree'),
+    ('Gleditsia triacanthos var. inermis', 'honeylocust'),
+    ('Pyrus calleryana', 'Callery pear'),
+    ('Quercus palustris', 'pin oak'),
+    ('Acer platanoides', 'Norway maple'),
+    ('Tilia cordata', 'littleleaf linden'),
+    ('Prunus', 'cherry'),
+    ('Zelkova serrata', 'Japanese zelkova'),
+    ('Ginkgo biloba', 'ginkgo'),
+    ('Styphnolobium japonicum', 'Sophora'),
+    ('Acer rubrum', 'red maple'),
+    ('Fraxinus pennsylvanica', 'green ash'),
+    ('Tilia americana', 'American linden'),
+    ('Acer saccharinum', 'silver maple'),
+    ('Malus', 'crab apple'),
+    ('Ulmus americana', 'American elm'),
+    ('Prunus serrulata', 'Kwanzan cherry'),
+    ('Quercus rubra', 'northern red oak'),
+    ('Cercis canadensis', 'eastern redbud'),
+    ('Celtis occidentalis', 'hackberry'),
+    ('Liquidambar styraciflua', 'sweetgum'),
+    ('Quercus bicolor', 'swamp white oak'),
+    ('Tilia tomentosa', 'silver linden'),
+    ('Ulmus pumila', 'Siberian elm'),
+    ('Gymnocladus dioicus', 'Kentucky coffeetree'),
+    ('Liriodendron tulipifera', 'tulip-poplar'),
+    ('Ailanthus altissima', 'tree of heaven'),
+    ('Carpinus betulus', 'European hornbeam'),
+    ('Amelanchier', 'serviceberry'),
+    ('Morus', 'mulberry'),
+]
+
+problem_names = ['Stones', 'BranchLights', 'RootOther', 'TrunkOther',
+                 'WiresRope', 'MetalGrates', 'BranchOther', 'Sneakers']
+
+
+def make_census(rows, seed=0, offset=0):
+    """Synthetic census in the raw Socrata format: one column per field,
+    all values as strings and None for empty fields. Large data sets can be
+    created in parts, offset is the number of trees in the previous parts."""
+
+    rng = np.random.default_rng(seed)
+    names = list(boroughs)
+    shares = np.array([boroughs[name][4] for name in names])
+    boro_idx = rng.choice(len(names), size=rows, p=shares / shares.sum())
+    box = np.array([boroughs[name][:4] for name in names])[boro_idx]
+
+    lat = box[:, 0] + rng.random(rows) * (box[:, 1] - box[:, 0])
+    lon = box[:, 2] + rng.random(rows) * (box[:, 3] - box[:, 2])
+
+    status = rng.choice(np.array(['Alive', 'Stump', 'Dead']), size=rows, p=[0.955, 0.025, 0.02])
+    alive = status == 'Alive'
+    health = rng.choice(np.array(['Good', 'Fair', 'Poor']), size=rows, p=[0.81, 0.15, 0.04])
+    spc = rng.integers(len(species), size=rows)
+    spc_latin = np.array([val[0] for val in species], dtype=object)[spc]
+    spc_common = np.array([val[1] for val in species], dtype=object)[spc]
+
+    tree_dbh = np.where(status == 'Alive', np.minimum(rng.gamma(2.2, 5.2, rows), 120).astype(int), 0)
+    stump_diam = np.where(status == 'Stump', rng.integers(1, 40, rows), 0)
+
+    ## problems: 'None' or a comma separated list of problem names
+    problem_flags = rng.random((rows, len(problem_names))) < 0.08
+    problem_lookup = {}
+    problems = np.empty(rows, dtype=object)
+    for row, flags in enumerate(np.packbits(problem_flags, axis=1, bitorder='little')[:, 0]):
+        if flags not in problem_lookup:
+            problem_lookup[flags] = ','.join(name for bit, name in enumerate(problem_names)
+                                             if flags & (1 << bit)) or 'None'
+        problems[row] = problem_lookup[flags]
+
+    yes_no = np.array(['No', 'Yes'])
+    def flag(col):
+        return yes_no[problem_flags[:, col].astype(int)]
+
+    boroname = np.array(names, dtype=object)[boro_idx]
+    borocode = np.array([boroughs[name][5] for name in names])[boro_idx]
+    boro_abbr = np.array([boroughs[name][6] for name in names], dtype=object)[boro_idx]
+    nta_num = rng.integers(1, 40, rows)
+    council_district = borocode * 10 + rng.integers(1, 10, rows)
+    postcode = 10000 + borocode * 150 + rng.integers(0, 120, rows)
+    census_tract = rng.integers(1, 1500, rows)
+    created_at = pd.Timestamp('2015-05-19') + pd.to_timedelta(rng.integers(0, 500, rows), unit='D')
+
+    def opt(values, mask):
+        values = np.asarray(values).astype(str).astype(object)
+        values[~mask] = None
+        return values
+
+    census = pd.DataFrame({
+        'tree_id': (180683 + (offset + np.arange(rows)) * 2 + rng.integers(0, 2, rows)).astype(str),
+        'block_id': rng.integers(100000, 520000, rows).astype(str),
+        'created_at': created_at.strftime('%Y-%m-%dT00:00:00.000'),
+        'tree_dbh': tree_dbh.astype(str),
+        'stump_diam': stump_diam.astype(str),
+        'curb_loc': rng.choice(np.array(['OnCurb', 'OffsetFromCurb']), size=rows, p=[0.96, 0.04]),
+        'status': status,
+        'health': opt(health, alive),
+        'spc_latin': opt(spc_latin, alive),
+        'spc_common': opt(spc_common, alive),
+        'steward': opt(rng.choice(np.array(['None', '1or2', '3or4', '4orMore']), size=rows, p=[0.73, 0.21, 0.05, 0.01]), alive),
+        'guards': opt(rng.choice(np.array(['None', 'Helpful', 'Harmful', 'Unsure']), size=rows, p=[0.87, 0.08, 0.03, 0.02]), alive),
+        'sidewalk': opt(rng.choice(np.array(['NoDamage', 'Damage']), size=rows, p=[0.71, 0.29]), alive),
+        'user_type': rng.choice(np.array(['Volunteer', 'TreesCount Staff', 'NYC Parks Staff']), size=rows),
+        'problems': opt(problems, alive),
+        'root_stone': flag(0),
+        'root_grate': flag(5),
+        'root_other': flag(2),
+        'trunk_wire': flag(4),
+        'trnk_light': flag(1),
+        'trnk_other': flag(3),
+        'brch_light': flag(1),
+        'brch_shoe': flag(7),
+        'brch_other': flag(6),
+        'address': np.char.add(rng.integers(1, 3000, rows).astype(str), ' SYNTHETIC STREET').astype(object),
+        'postcode': postcode.astype(str),
+        'zip_city': boroname,
+        'community board': (borocode * 100 + rng.integers(1, 18, rows)).astype(str),
+        'borocode': borocode.astype(str),
+        'borough': boroname,
+        'boroname': boroname,
+        'cncldist': council_district.astype(str),
+        'st_assem': rng.integers(23, 87, rows).astype(str),
+        'st_senate': rng.integers(10, 36, rows).astype(str),
+        'nta': np.char.add(boro_abbr.astype(str), np.char.zfill(nta_num.astype(str), 2)).astype(object),
+        'nta_name': np.char.add(np.char.add(boroname.astype(str), ' District '), nta_num.astype(str)).astype(object),
+        'boro_ct': (borocode * 1000000 + census_tract * 100).astype(str),
+        'state': 'New York',
+        'latitude': np.char.mod('%.8f', lat).astype(object),
+        'longitude': np.char.mod('%.8f', lon).astype(object),
+        'x_sp': np.char.mod('%.4f', 1000000 + (lon + 74.25) * 260000).astype(object),
+        'y_sp': np.char.mod('%.4f', 120000 + (lat - 40.5) * 365000).astype(object),
+        'council_district': council_district.astype(str),
+        'census_tract': census_tract.astype(str),
+        'bin': rng.integers(1000000, 5999999, rows).astype(str),
+        'bbl': rng.integers(1000000000, 5999999999, rows).astype(str),
+    })
+
+    return census
+
+
+def add_system_fields(census):
+    census[':id'] = ['row-{:x}'.format(val) for val in range(len(census))]
+    census[':created_at'] = '2017-07-20T16:32:24.391Z'
+    census[':updated_at'] = '2017-07-20T16:32:24.391Z'
+    return census
+
+
+def update_trees(census, rows, seed=1):
+    """Simulate changes on the server: new health status for some trees."""
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(np.flatnonzero(census['status'] == 'Alive'), size=rows, replace=False)
+    census.loc[idx, 'health'] = rng.choice(np.array(['Good', 'Fair', 'Poor']), size=rows)
+    census.loc[idx, ':updated_at'] = pd.Timestamp.now('UTC').strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return census.loc[idx, 'tree_id'].to_list()
+
+
+def to_records(census):
+    ## Socrata leaves out empty values
+    return [{key: val for key, val in record.items() if val is not None}
+            for record in census.to_dict('records')]
+
+
+where_updated_at = re.compile(r"^\s*:updated_at\s*>\s*'([^']*)'\s*$")
+
+
+def make_handler(census, dataset='uvpi-gqnh', fail_every=0):
+
+    if ':updated_at' not in census:
+        add_system_fields(census)
+
+    lock = threading.Lock()
+    request_count = [0]
+    order_cache = {}
+
+    class SocrataHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: val[0] for key, val in parse_qs(url.query).items()}
+
+            if url.path != '/resource/{}.json'.format(dataset):
+                self.send_error(404, 'Unknown dataset')
+                return
+
+            ## simulate an unreliable server, every n-th request fails
+            with lock:
+                request_count[0] += 1
+                failing = fail_every and request_count[0] % fail_every == 0
+            if failing:
+                self.send_error(503, 'Service unavailable')
+                return
+
+            selected = np.ones(len(census), dtype=bool)
+            where = params.get('$where')
+            if where:
+                match = where_updated_at.match(where)
+                if not match:
+                    self.send_error(400, 'Unsupported $where')
+                    return
+                selected = (census[':updated_at'] > match.group(1)).to_numpy()
+
+            select = params.get('$select', '')
+            if select.upper() == 'COUNT(*)':
+                self.send_json([{'COUNT': str(selected.sum())}])
+                return
+            columns = [col.strip().strip('`') for col in select.split(',') if col.strip()]
+
+            rows = np.arange(len(census))
+            order = params.get('$order')
+            if order:
+                ## the sort order of the complete data set is computed once
+                if order not in order_cache:
+                    key = pd.to_numeric(census[order], errors='coerce').to_numpy()
+                    order_cache[order] = np.argsort(key, kind='stable')
+                rows = order_cache[order]
+            rows = rows[selected[rows]]
+
+            offset = int(params.get('$offset', 0))
+            limit = int(params.get('$limit', 1000))
+            data = census.iloc[rows[offset:offset + limit]]
+            if columns:
+                data = data[[col for col in columns if col in data]]
+            if params.get('$$exclude_system_fields', 'true').lower() != 'false':
+                data = data[[col for col in data.columns if not col.startswith(':')]]
+
+            self.send_json(to_records(data))
+
+        def send_json(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SocrataHandler
+
+
+def start_server(rows=20000, port=8051, seed=0, fail_every=0):
+    """Start the stand-in server in a background thread, returns the server.
+    Use port 0 for any free port (see server.server_address)."""
+    census = make_census(rows, seed)
+    server = ThreadingHTTPServer(('localhost', port), make_handler(census, fail_every=fail_every))
+    ## keep a reference, e.g. for update_trees()
+    server.census = census
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='number of synthetic trees')
+    parser.add_argument('--port', type=int, default=8051)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help='let every n-th request fail with 503 (tests the retry)')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('localhost', args.port),
+                                 make_handler(make_census(args.rows, args.seed), fail_every=args.fail_every))
+    print('Serving {} synthetic trees on http://localhost:{}'.format(args.rows, args.port))
+    server.serve_forever()
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of trees_of_nyc.py against the local Socrata stand-in (socrata_stub.py),
+no network access is needed:
+
+    python -m pytest test_trees_of_nyc.py
+"""
+
+import io
+import json
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+import socrata_stub
+
+with warnings.catch_warnings():
+    ## deprecated dash component packages
+    warnings.simplefilter('ignore')
+    import trees_of_nyc as app
+
+
+def start_stub(rows, fail_every=0):
+    server = socrata_stub.start_server(rows=rows, port=0, fail_every=fail_every)
+    server.url = 'http://localhost:{}'.format(server.server_address[1])
+    return server
+
+
+@pytest.fixture(scope='module')
+def stub():
+    server = start_stub(2500)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def source(stub, monkeypatch, tmp_path):
+    ## small pages, the cache in a temporary directory
+    monkeypatch.setattr(app, 'datasource', stub.url)
+    monkeypatch.setattr(app, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(app, 'page_size', 1000)
+    return stub
+
+
+@pytest.fixture(scope='module')
+def census(stub):
+    ## the census of the stand-in as downloaded and cleaned by the app
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(app, 'datasource', stub.url)
+        patch.setattr(app, 'use_cache', False)
+        return app.get_data(2500)
+
+
+@pytest.fixture
+def loaded(census, monkeypatch, tmp_path):
+    ## the app with the census loaded by the test, not by a loader thread.
+    ## Jobs run in threads and write to a temporary directory
+    monkeypatch.setattr(app, 'loader', threading.current_thread())
+    monkeypatch.setitem(app.load_state, 'status', 'ready')
+    monkeypatch.setattr(app.job_queue, 'path', str(tmp_path / 'jobs'))
+    app.init_data(*census)
+    yield app.tree_data
+    app.job_queue.stop()
+
+
+def post_callback(output, values, changed):
+    ## posts a callback with a single output like the browser does, values of
+    ## the inputs and states by 'id.property'
+    client = app.app.server.test_client()
+    dep = next(dep for dep in client.get('/_dash-dependencies').get_json() if dep['output'] == output)
+    props = lambda items: [dict(val, value=values.get('{}.{}'.format(val['id'], val['property'])))
+                           for val in items]
+    body = {'output': output, 'outputs': dict(zip(['id', 'property'], output.split('.', 1))),
+            'inputs': props(dep['inputs']), 'state': props(dep['state']), 'changedPropIds': changed}
+    return client.post('/_dash-update-component', json=body)
+
+
+def census_ids(census, rows):
+    ## tree_ids of the first rows of the census, as downloaded
+    return np.sort(census['tree_id'].astype(np.int64).to_numpy())[:rows]
+
+
+def test_download_rows_in_pages(source):
+
+    pages = []
+    df, updated_at = app.download_rows(2500, on_page=lambda page, done, total: pages.append((len(page), total)))
+
+    assert sorted(pages) == [(500, 3), (1000, 3), (1000, 3)]
+    assert len(df) == 2500
+    np.testing.assert_array_equal(df['tree_id'].to_numpy(), census_ids(source.census, 2500))
+    assert not [col for col in df.columns if col.startswith(':')]
+    assert updated_at == source.census[':updated_at'].max()
+    assert df['tree_id'].dtype == np.int32
+    assert isinstance(df['health'].dtype, pd.CategoricalDtype)
+
+
+def test_download_rows_retries_failed_pages(monkeypatch):
+
+    ## every second request fails once, each page succeeds on its retry
+    server = start_stub(1500, fail_every=2)
+    monkeypatch.setattr(app, 'datasource', server.url)
+    monkeypatch.setattr(app, 'page_size', 500)
+    monkeypatch.setattr(app, 'download_workers', 1)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    try:
+        df, _ = app.download_rows(1500)
+    finally:
+        server.shutdown()
+
+    np.testing.assert_array_equal(df['tree_id'].to_numpy(), census_ids(server.census, 1500))
+
+
+def test_download_rows_gives_up_after_retries(monkeypatch):
+
+    server = start_stub(100, fail_every=1)
+    monkeypatch.setattr(app, 'datasource', server.url)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    try:
+        with pytest.raises(requests.exceptions.RequestException):
+            app.download_rows(100)
+    finally:
+        server.shutdown()
+
+
+def test_get_data_reads_cache(source, monkeypatch):
+
+    df, record_count_total = app.get_data(1500)
+    assert len(df) == 1500
+    assert record_count_total == 2500
+
+    ## the second start doesn't download anything
+    def no_download(*args, **kwargs):
+        raise AssertionError('downloaded although cached')
+    monkeypatch.setattr(app, 'download_rows', no_download)
+    monkeypatch.setattr(app, 'count_rows', no_download)
+
+    cached, cached_count = app.get_data(1500)
+    pd.testing.assert_frame_equal(cached, df)
+    assert cached_count == record_count_total
+
+
+def test_get_data_keeps_sources_apart(source, monkeypatch):
+
+    df, _ = app.get_data(500)
+
+    ## the same data_limit from another server is downloaded, not read from
+    ## the cache of the first one
+    server = start_stub(700)
+    monkeypatch.setattr(app, 'datasource', server.url)
+    try:
+        other, record_count_total = app.get_data(500)
+    finally:
+        server.shutdown()
+    assert record_count_total == 700
+    monkeypatch.setattr(app, 'datasource', source.url)
+    pd.testing.assert_frame_equal(app.get_data(500)[0], df)
+
+
+def test_get_data_with_other_columns(source, monkeypatch):
+
+    assert 'nta_name' in app.get_data(500)[0].columns
+
+    ## another projection is downloaded again
+    monkeypatch.setattr(app, 'select_columns', ['boroname'])
+    df, _ = app.get_data(500)
+    assert set(df.columns) == set(app.required_columns + ['tree_dbh_vis'])
+
+    ## only the statistics of the downloaded columns are offered
+    expected = [{'label': 'Borough', 'value': 'boroname'}, {'label': 'Species', 'value': 'spc_common'}]
+    assert app.make_stats_dimension_options(app.TreeData()) == expected
+    data = app.TreeData(df, 500)
+    assert app.make_stats_dimension_options(data) == expected
+    monkeypatch.setattr(app, 'tree_data', data)
+    filter_state = app.make_filter_state(list(data.borough_names), list(data.health_status))
+    assert app.update_statistics(filter_state, 'nta_name', 'Trees')[:2] == ([], [])
+
+
+def test_refresh_data_merges_changed_rows(monkeypatch, tmp_path):
+
+    server = start_stub(1200)
+    monkeypatch.setattr(app, 'datasource', server.url)
+    monkeypatch.setattr(app, 'cache_dir', str(tmp_path / 'cache'))
+    try:
+        df, _ = app.get_data(1000)
+        changed = socrata_stub.update_trees(server.census, 100)
+        refreshed, _ = app.get_data(1000, refresh=True)
+        with open(app.cache_paths(1000)[1]) as f:
+            meta = json.load(f)
+    finally:
+        server.shutdown()
+
+    ## same trees, the changed ones with their new health status
+    assert len(refreshed) == 1000
+    np.testing.assert_array_equal(refreshed['tree_id'].to_numpy(), df['tree_id'].to_numpy())
+    health = dict(zip(server.census['tree_id'].astype(int), server.census['health']))
+    changed = [int(val) for val in changed if int(val) in set(df['tree_id'])]
+    assert changed
+    refreshed_health = dict(zip(refreshed['tree_id'], refreshed['health'].astype(str)))
+    assert [refreshed_health[val] for val in changed] == [health[val] for val in changed]
+    assert meta['updated_at'] == server.census[':updated_at'].max()
+
+
+def test_refresh_data_without_changes(source):
+    df, _ = app.get_data(500)
+    refreshed, record_count_total = app.get_data(500, refresh=True)
+    pd.testing.assert_frame_equal(refreshed, df)
+    assert record_count_total == 2500
+
+
+def test_get_data_without_rows(source):
+
+    ## e.g. data_limit 0 or an empty data set: no trees, but the columns
+    ## and types of the cleaned data
+    df, record_count_total = app.get_data(0)
+    assert len(df) == 0
+    assert record_count_total == 2500
+    assert set(app.required_columns + ['tree_dbh_vis']) <= set(df.columns)
+    assert df['tree_id'].dtype == np.int32
+    assert isinstance(df['boroname'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(app.get_data(0)[0], df)
+
+    ## the app shows an empty map
+    app.init_data(df, record_count_total)
+    filter_state = app.update_filtered_data(['Queens'], ['Good'])
+    figure, _, _ = app.update_graph_mapbox(filter_state, {'zoom': app.map_zoom, 'level': app.zoom_level(app.map_zoom)})
+    assert figure['data'][0]['lat'] == []
+    assert app.get_tree_records(app.tree_data, [1]) == {}
+
+
+def test_preview_without_system_fields(source, monkeypatch):
+    monkeypatch.setattr(app, 'tree_data', app.TreeData())
+    app.show_preview(app.download_page(0, 100), 1, 3)
+    assert app.tree_data.df_count == 100
+    assert not [col for col in app.tree_data.df.columns if col.startswith(':')]
+
+
+def test_filter_cache_keeps_data_versions_apart(loaded, census):
+
+    filter_state = app.make_filter_state(['Queens', 'Brooklyn'], ['Good', 'Fair'])
+    app.resolve_filter(loaded, filter_state)
+
+    ## new data is swapped in while a callback still filters the old data
+    app.init_data(census[0].iloc[:1000], census[1])
+    stale = app.resolve_filter(loaded, filter_state)
+    current = app.resolve_filter(app.tree_data, filter_state)
+
+    assert len(stale['mask']) == 2500
+    assert len(current['mask']) == 1000
+    expected = census[0].iloc[:1000]['boroname'].isin(['Queens', 'Brooklyn']) & \
+        census[0].iloc[:1000]['health'].isin(['Good', 'Fair'])
+    np.testing.assert_array_equal(current['mask'], expected.to_numpy())
+
+
+def test_export_selection_on_another_worker(loaded):
+
+    filter_state = app.make_filter_state(list(loaded.borough_names), ['Good'])
+    geometry = {'range': {'mapbox': [[-74.3, 40.9], [-73.9, 40.5]]}}
+    selection, _ = app.update_user_selected_data(geometry, filter_state)
+    expected = app.resolve_selection(loaded, selection)
+    assert selection['count'] == len(expected) > 0
+
+    ## a worker that has never seen the selection
+    app.selection_cache.clear()
+    response = app.app.server.test_client().get(app.export_url('graph_select', 'csv', selection=selection))
+    assert response.status_code == 200
+    exported = pd.read_csv(io.BytesIO(response.data))
+    np.testing.assert_array_equal(exported['tree_id'].to_numpy(), loaded.df['tree_id'].to_numpy()[expected])
+    assert set(exported['health']) == {'Good'}
+
+    ## the export button
+    app.selection_cache.clear()
+    response = post_callback('store_export_jobs.data', {'btn_graph_select_csv.n_clicks': 1,
+                                                        'store_df_filtered.data': filter_state,
+                                                        'store_df_graph_select.data': selection},
+                             ['btn_graph_select_csv.n_clicks'])
+    assert response.status_code == 200
+    [job] = response.get_json()['response']['store_export_jobs']['data']
+    app.job_queue.wait(job['key'])
+    exported = pd.read_csv(app.os.path.join(app.job_queue.path, job['key'], job['name']))
+    assert len(exported) == len(expected)
+
+    response = app.app.server.test_client().get('/export/graph_select.csv?selection=%5B1%5D')
+    assert response.status_code == 400
+
+
+def test_jobs_of_other_processes(loaded, monkeypatch):
+
+    filter_state = app.make_filter_state(list(loaded.borough_names), list(loaded.health_status))
+    params = {'filter_state': filter_state, 'dimension': 'boroname'}
+    key = app.job_queue.submit('statistics', params)
+    app.job_queue.wait(key)
+    expected = app.job_queue.result(key)
+    path = app.os.path.join(app.job_queue.path, key)
+    assert not [name for name in app.os.listdir(path) if name.endswith('.tmp')]
+
+    ## the same job running in another process is waited for, not started again
+    app.job_queue.futures.pop(key, None)
+    app.write_job_status(path, 'running', 0.5)
+    monkeypatch.setattr(app, 'job_wait_interval', 0.01)
+    assert app.job_queue.submit('statistics', params) == key
+    assert key not in app.job_queue.futures
+    finish = threading.Timer(0.2, app.write_job_status, (path, 'done', 1))
+    finish.start()
+    app.job_queue.wait(key)
+    assert app.job_queue.status(key)['state'] == 'done'
+    pd.testing.assert_frame_equal(app.job_queue.result(key), expected)
+
+    ## a lost job is started again
+    app.write_job_status(path, 'running', 0.5)
+    monkeypatch.setattr(app, 'job_stale_after', 0)
+    assert app.job_queue.submit('statistics', params) == key
+    assert key in app.job_queue.futures
+    app.job_queue.wait(key)
+    pd.testing.assert_frame_equal(app.job_queue.result(key), expected)
+
+
+def blocked_job(monkeypatch, kind):
+    ## the job of kind runs when the returned event is set
+    event, run = threading.Event(), app.job_kinds[kind]
+    monkeypatch.setitem(app.job_kinds, kind, lambda *args: event.wait(10) and run(*args))
+    return event
+
+
+def test_density_map_polls_job(loaded, monkeypatch):
+
+    filter_state = app.make_filter_state(list(loaded.borough_names), ['Good'])
+    map_view = {'zoom': app.map_zoom, 'level': app.zoom_level(app.map_zoom)}
+    release = blocked_job(monkeypatch, 'density')
+
+    ## the aggregated trees while the job runs, the interval polls it
+    figure, state, disabled = app.update_graph_mapbox(filter_state, map_view, 'density')
+    assert figure['data'][0]['type'] == 'scattermapbox'
+    assert state['job'] and not disabled
+    assert app.update_graph_mapbox(filter_state, map_view, 'density', 1, state) == (
+        app.dash.no_update, app.dash.no_update, False)
+
+    release.set()
+    app.job_queue.wait(state['job'])
+    figure, state, disabled = app.update_graph_mapbox(filter_state, map_view, 'density', 2, state)
+    assert figure['data'][0]['type'] == 'densitymapbox'
+    assert state is None and disabled
+
+
+def test_xlsx_export_is_polled(loaded, monkeypatch):
+
+    pytest.importorskip('openpyxl')
+    client = app.app.server.test_client()
+    release = blocked_job(monkeypatch, 'export')
+
+    ## 202 Accepted while the job runs, the file from the job's location
+    response = client.get('/export/filtered.xlsx?borough=Bronx&health=Good')
+    assert response.status_code == 202
+    assert response.get_json()['state'] in ('queued', 'running')
+    location = response.headers['Location']
+    assert location == '/jobs/' + response.get_json()['job']
+    assert client.get(location).status_code == 202
+
+    release.set()
+    app.job_queue.wait(response.get_json()['job'])
+    response = client.get(location)
+    assert response.status_code == 200
+    exported = pd.read_excel(io.BytesIO(response.data))
+    assert len(exported) == ((loaded.df['boroname'] == 'Bronx') & (loaded.df['health'] == 'Good')).sum()
+    assert client.get('/export/filtered.xlsx?borough=Bronx&health=Good').status_code == 200
+    assert client.get('/jobs/0123456789abcdef').status_code == 404
+
+
+def test_statistics_without_jobs(loaded, monkeypatch):
+
+    boroughs, health = ['Queens', 'Bronx'], list(loaded.health_status)
+    species = list(loaded.df[app.species_dimension].dropna().unique()[:2])
+    filtered = loaded.df[loaded.df['boroname'].isin(boroughs)]
+
+    ## a species selection is computed by a job, polled until it is done
+    filter_state = app.make_filter_state(boroughs, health, species)
+    app.update_statistics(filter_state, 'boroname', 'Trees')
+    app.job_queue.wait(app.job_queue.submit('statistics', {'dimension': 'boroname', 'filter_state': filter_state}))
+    _, species_records, _, done = app.update_statistics(filter_state, 'boroname', 'Trees', 1)
+    assert done
+    assert sum(val['Trees'] for val in species_records) == filtered[app.species_dimension].isin(species).sum()
+
+    ## the cube answers without a job
+    def no_job(*args, **kwargs):
+        raise AssertionError('statistics computed by a job')
+    monkeypatch.setattr(app.job_queue, 'submit', no_job)
+
+    _, records, _, _ = app.update_statistics(app.make_filter_state(boroughs, health), 'boroname', 'Trees')
+    counts = filtered['boroname'].value_counts()
+    assert {val['Borough']: val['Trees'] for val in records} == counts[counts > 0].to_dict()
+    with pytest.raises(AssertionError):
+        app.update_statistics(app.make_filter_state(boroughs, health, species), 'boroname', 'Trees')
+
+
+def test_client_stats_slice_like_cubes(loaded):
+
+    ## the cubes sent for the statistics in client mode, sliced by borough
+    ## and health status as in assets/clientside.js
+    stats = app.make_client_stats(loaded)
+    decode = lambda value: np.frombuffer(app.base64.b64decode(value['bdata']), dtype=value['dtype'])
+    boroughs, health = ['Queens', 'Bronx'], ['Good', 'Dead']
+    for dim, cube in stats['cubes'].items():
+        selected = (np.isin(decode(cube['borough']), [loaded.borough_names.index(val) for val in boroughs])
+                    & np.isin(decode(cube['health']), [loaded.health_status.index(val) for val in health]))
+        trees = pd.Series(decode(cube['trees'])[selected]).groupby(decode(cube['value'])[selected]).sum()
+        trees.index = np.array(cube['values'])[trees.index]
+        expected = loaded.stats_cube.statistics(dim, {'boroname': boroughs, 'health': health})['Trees']
+        assert trees[trees > 0].to_dict() == expected.to_dict()
+        assert stats['labels'][dim] in app.stats_dimensions
+
+
+def test_shared_data_is_mapped(census, monkeypatch, tmp_path):
+
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(app, 'shared_dir', str(tmp_path))
+    df, record_count_total = census
+    app.write_shared(df, record_count_total, str(tmp_path / 'data'))
+    shared_df, meta, shared = app.read_shared(str(tmp_path / 'data'))
+
+    ## views of the read-only mapped files, not copies
+    pd.testing.assert_frame_equal(shared_df, df, check_dtype=False)
+    assert not shared_df['health'].cat.codes.to_numpy().flags.writeable
+    assert not shared_df['latitude'].to_numpy().flags.writeable
+    assert not shared['count_cube'].to_numpy().flags.writeable
+    assert not shared['stats_cubes']['boroname']['trees'].to_numpy().flags.writeable
+
+    ## the shared cubes answer like the computed ones
+    computed, mapped = app.TreeData(df, record_count_total), app.TreeData(shared_df, record_count_total, 1, shared)
+    selections = {'boroname': ['Queens', 'Bronx'], 'health': ['Good', 'Poor']}
+    pd.testing.assert_series_equal(mapped.count_cube.counts_by('health', selections),
+                                   computed.count_cube.counts_by('health', selections), check_dtype=False)
+    for dim in app.stats_dimensions.values():
+        pd.testing.assert_frame_equal(mapped.stats_cube.statistics(dim, selections),
+                                      computed.stats_cube.statistics(dim, selections), check_dtype=False)
+    pd.testing.assert_frame_equal(mapped.grid_bins.aggregate(0, selections, 100),
+                                  computed.grid_bins.aggregate(0, selections, 100), check_dtype=False)
+
+
+def test_shared_jobs_run_once_per_host(census, monkeypatch, tmp_path):
+
+    ## two app processes of the host with the same shared data and job_dir
+    pytest.importorskip('pyarrow')
+    df, record_count_total = census
+    app.write_shared(df, record_count_total, str(tmp_path / 'data'))
+    first, second = app.JobQueue(1, str(tmp_path / 'jobs')), app.JobQueue(1, str(tmp_path / 'jobs'))
+    for queue in (first, second):
+        queue.configure(('shared', str(tmp_path / 'data')))
+    filter_state = app.make_filter_state(list(df['boroname'].cat.categories), ['Good'])
+    try:
+        ## the first job starts the job processes, jobs of the other process
+        ## are queued for them
+        key = first.submit('statistics', {'dimension': 'boroname', 'filter_state': filter_state})
+        other = second.submit('statistics', {'dimension': 'nta_name', 'filter_state': filter_state})
+        assert first.executor is not None and second.executor is None
+        assert second.submit('statistics', {'dimension': 'boroname', 'filter_state': filter_state}) == key
+        second.wait(other)
+        first.wait(key)
+        assert second.executor is None
+        assert second.result(other)['Trees'].sum() == first.result(key)['Trees'].sum() == (df['health'] == 'Good').sum()
+
+        ## the other process takes over when the job processes are gone
+        first.stop()
+        key = second.submit('statistics', {'dimension': 'spc_common', 'filter_state': filter_state})
+        second.wait(key)
+        assert second.executor is not None
+    finally:
+        first.stop()
+        second.stop()
+
+
+def test_map_patches_traces_in_points_view(loaded, monkeypatch):
+
+    ## zoomed in, more filtered trees than max_markers
+    monkeypatch.setattr(app, 'max_markers', 100)
+    boroughs = list(loaded.borough_names)
+    map_view = {'zoom': 15, 'level': 'points', 'bounds': [40.4, 41.0, -74.3, -73.6]}
+
+    figure, state, _ = app.update_graph_mapbox(app.make_filter_state(boroughs, ['Good']), map_view)
+    assert state['bounds'] == map_view['bounds']
+    assert len(figure['data']) == len(state['traces']) == len(boroughs)
+
+    ## another health status in the same map section: only its traces are sent
+    patch, patched, _ = app.update_graph_mapbox(app.make_filter_state(boroughs, ['Good', 'Fair']), map_view,
+                                                map_traces=state)
+    assert isinstance(patch, app.dash.Patch)
+    assert patched['traces'][:len(boroughs)] == state['traces']
+    assert sorted(patched['traces'][len(boroughs):]) == sorted(app.slice_uid(val, 'Fair') for val in boroughs)
+
+    ## another map section needs a new figure
+    moved = dict(map_view, bounds=[40.5, 40.8, -74.1, -73.8])
+    figure, state, _ = app.update_graph_mapbox(app.make_filter_state(boroughs, ['Good', 'Fair']), moved,
+                                               map_traces=patched)
+    assert isinstance(figure, dict) and state['bounds'] == moved['bounds']
+
+
+def test_metrics_format(monkeypatch):
+
+    monkeypatch.setattr(app, 'loader', threading.current_thread())
+    response = app.app.server.test_client().get('/metrics')
+    lines = response.get_data(as_text=True).splitlines()
+    assert '# TYPE trees_cache_hits_total counter' in lines
+    assert '# TYPE trees_cache_misses_total counter' in lines
+    assert [val for val in lines if val.startswith('trees_cache_hits_total{cache="filter"} ')]
+
+    metrics = app.Metrics()
+    metrics.describe('test_total', 'counter', 'Line\nwith \\ backslash')
+    metrics.inc('test_total', {'name': 'say "hi"\\\n'})
+    assert metrics.render().splitlines() == ['# HELP test_total Line\\nwith \\\\ backslash',
+                                             '# TYPE test_total counter',
+                                             'test_total{name="say \\"hi\\"\\\\\\n"} 1']
+
+
+def test_api_trees_rejects_invalid_ids(loaded):
+
+    client = app.app.server.test_client()
+    tree_ids = [int(val) for val in loaded.df['tree_id'][:3]]
+    response = client.post('/api/trees', json={'tree_ids': tree_ids + [-1]})
+    assert response.status_code == 200
+    assert sorted(response.get_json()['trees']) == sorted(str(val) for val in tree_ids)
+    assert response.get_json()['missing'] == [-1]
+
+    for body in [{'tree_ids': [True]}, {'tree_ids': [tree_ids[0], False]}, {'tree_ids': ['1']},
+                 {'tree_ids': 1}, [tree_ids[0]]]:
+        assert client.post('/api/trees', json=body).status_code == 400
@@ -20,14 +20,63 @@ possible analytical questions:
 
 """
 
+import os
+import json
+import bisect
+import base64
+import time
+import zlib
+import cProfile
+import functools
+import contextlib
+import hashlib
+import pickle
+import shutil
+import tempfile
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np 
+import requests
 import dash
 import dash_table
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.express as px
+import plotly.graph_objects as go
+from plotly.utils import PlotlyJSONEncoder
 from sodapy import Socrata
 import pandas as pd
+import flask
+from urllib.parse import urlencode
+
+try:
+    import flask_compress
+except ImportError:
+    ## callback responses are sent uncompressed
+    flask_compress = None
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    ## without pyarrow the data is downloaded on every start
+    pyarrow = None
+
+try:
+    import fcntl
+except ImportError:
+    ## no shared memory mode on Windows
+    fcntl = None
+
+## the module only logs to its logger. Logging is set up with log_format by
+## the entry points: the __main__ block, gunicorn.conf.py and the job
+## processes. Other hosts importing the module route the messages themselves
+logger = logging.getLogger(__name__)
+log_format = '%(asctime)s %(levelname)s %(name)s: %(message)s'
 
 ## predefined order for different health options
 ## although 'Alive' exists but just once, probably erroneous entry
@@ -36,13 +85,321 @@ health_status_order = ['Good', 'Fair', 'Poor', 'Dead', 'Stump']
 # max number of data points. Last time I checked there were 683788 data points available
 data_limit = 20000
 
-
-def get_data(data_limit=2000):
-
-    # data source
-    datasource = "data.cityofnewyork.us"
-    dataset = "uvpi-gqnh"
-    timeout = 30
+## data source. For testing without network access the data can be served
+## from a local stand-in server, e.g. TREES_DATASOURCE=http://localhost:8051
+## (see socrata_stub.py)
+datasource = os.environ.get('TREES_DATASOURCE', 'data.cityofnewyork.us')
+dataset = 'uvpi-gqnh'
+timeout = 30
+
+## the data is downloaded in pages of page_size rows, ordered by tree_id.
+## download_workers pages are requested in parallel, each failed page is
+## retried up to page_retries times
+page_size = 50000
+download_workers = 4
+page_retries = 3
+
+## the cleaned data is cached on disk (requires pyarrow) and loaded from there
+## on the next start. Increase schema_version whenever clean_data() changes
+## the layout of the DataFrame. With TREES_REFRESH=1 only rows changed since
+## the cached snapshot are downloaded and merged into the cached data
+use_cache = True
+cache_dir = 'cache'
+schema_version = 2
+cache_refresh = os.environ.get('TREES_REFRESH', '') not in ('', '0')
+
+## shared memory mode for several worker processes, e.g. gunicorn -w 4. With
+## TREES_SHARED_DIR=<dir> (best on a tmpfs like /dev/shm) one worker loads the
+## data and writes it together with its indexes and cubes to memory mapped
+## files. All workers map these files read-only instead of keeping their own
+## copy or computing the cubes again. Requires pyarrow
+shared_dir = os.environ.get('TREES_SHARED_DIR')
+process_start = time.time()
+if shared_dir and (pyarrow is None or fcntl is None):
+    logger.warning('Shared memory mode needs pyarrow and fcntl, every worker loads its own data')
+    shared_dir = None
+
+## optional column projection, e.g. select_columns = ['boroname', 'nta_name'].
+## Only these columns (plus the columns required by the app) are downloaded.
+## None downloads all columns. Names with spaces need backticks in SoQL,
+## e.g. '`community board`'
+select_columns = None
+required_columns = ['tree_id', 'latitude', 'longitude', 'tree_dbh', 'stump_diam',
+                    'status', 'health', 'spc_latin', 'spc_common', 'problems', 'boroname']
+
+## text columns with few distinct values are stored as categoricals
+category_columns = ['boroname', 'borough', 'health', 'status', 'spc_common', 'spc_latin',
+                    'problems', 'curb_loc', 'steward', 'guards', 'sidewalk', 'user_type',
+                    'root_stone', 'root_grate', 'root_other', 'trunk_wire', 'trnk_light',
+                    'trnk_other', 'brch_light', 'brch_shoe', 'brch_other', 'zip_city',
+                    'state', 'nta', 'nta_name', 'postcode', 'community board', 'borocode',
+                    'cncldist', 'st_assem', 'st_senate', 'council_district', 'census_tract',
+                    'created_at']
+
+## filter results are kept on the server in a LRU cache with at most
+## filter_cache_size entries. The dcc.Store components only hold the key
+filter_cache_size = 8
+
+## tree counts for every combination of these columns are computed once after
+## loading. The checklist labels are taken from this count cube
+cube_dimensions = ['boroname', 'health']
+
+## district statistics: tree counts and diameters for every value of these
+## columns (and every borough and health status) are computed once after
+## loading. The statistics table and bar chart slice them by the current
+## filter. Ratios are only ranked for values with at least stats_min_trees
+## trees, the bar chart shows the stats_bar_count highest values
+stats_dimensions = {'Borough': 'boroname',
+                    'Neighborhood (NTA)': 'nta_name',
+                    'Council district': 'council_district',
+                    'Zip code': 'postcode',
+                    'Species': 'spc_common'}
+stats_measures = ['Trees', '% Poor', '% Dead', '% Stump', 'Mean diameter']
+stats_min_trees = 20
+stats_bar_count = 25
+
+## level of detail of the map: below lod_zoom trees are aggregated into
+## square grid cells (cell sizes in degrees), at most max_markers markers are
+## sent to the browser. Cells are chosen to be about lod_cell_pixels wide
+map_center = {'lat': 40.70, 'lon': -73.95}
+map_zoom = 10
+lod_zoom = 14
+max_markers = 5000
+lod_cell_pixels = 30
+grid_resolutions = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05]
+
+## when zoomed in, only trees in the visible part of the map plus view_margin
+## (share of the map width and height on each side) are sent, at most
+## max_points. The spatial index uses square cells of index_cell_size degrees
+view_margin = 0.5
+max_points = 50000
+index_cell_size = 0.005
+
+## density mode of the map: the filtered trees (e.g. health status Poor, Dead
+## and Stump) are counted in grid cells of the grid_resolutions, smoothed
+## with a gaussian kernel of density_sigma cells, only cells above
+## density_min are sent. Coarser cells are used for more than
+## density_max_cells cells. Results are cached for density_cache_size
+## combinations of filter and resolution
+density_sigma = 1.5
+density_min = 0.05
+density_max_cells = 20000
+density_cache_size = 16
+
+## species filter: the dropdown finds species whose common or latin name (or
+## a word of it) starts with the typed text, then species containing it. At
+## most species_search_limit species are offered. The trees of each species
+## are kept as row positions, a species selection is combined with the
+## borough and health status selection on these rows only
+species_dimension = 'spc_common'
+species_search_limit = 30
+
+## exports are streamed in chunks of export_chunk_size rows. Graphical
+## selections are kept in a LRU cache with selection_cache_size entries
+export_chunk_size = 10000
+selection_cache_size = 32
+
+## trait/value records of single trees are cached for tree_cache_size trees.
+## The tree API returns at most max_batch_trees trees per request
+tree_cache_size = 1024
+max_batch_trees = 1000
+
+## heavy work runs as jobs: exports, density maps and the statistics of
+## species selections. Callbacks and routes don't wait for a job, the browser
+## polls it every job_poll_interval milliseconds. Identical requests share one
+## job, results are stored in job_dir and reused for the same request and data
+## for at most job_max_age seconds. Jobs run in job_workers threads of the app
+## process. With shared data (see shared_dir) they run in one pool of
+## job_workers processes for the whole host, which map the shared files: the
+## first app process with a job starts the pool, the other processes (e.g.
+## gunicorn workers) queue their jobs in job_dir. The pool looks for queued
+## jobs every job_wait_interval seconds. A job whose status wasn't updated for
+## job_stale_after seconds is taken as lost and started again
+job_workers = 2
+job_dir = 'jobs'
+job_max_age = 3600
+job_poll_interval = 500
+job_wait_interval = 0.1
+job_stale_after = 600
+
+## callback latencies, payload sizes and errors as well as the timings of the
+## data loading phases are served in Prometheus format at /metrics. With
+## TREES_PROFILE_SLOW=<seconds>, callbacks run under cProfile and the profile
+## of each slower call is written to profile_dir
+profile_slow_callbacks = float(os.environ.get('TREES_PROFILE_SLOW', 0))
+profile_dir = 'profiles'
+
+## the data is loaded in a background thread, the app is served right away.
+## The browser polls the progress every load_poll_interval milliseconds. The
+## first downloaded page is shown while the remaining pages are loading
+load_poll_interval = 1000
+
+## client mode for kiosks: with TREES_CLIENT_MODE=1, the coordinates, borough,
+## health status and marker size of all trees are sent to the browser once,
+## with the statistics cubes. Filtering, checklist labels, the map and the
+## statistics run in the browser (see assets/clientside.js), all trees are
+## shown without level of detail and density mode
+client_mode = os.environ.get('TREES_CLIENT_MODE', '') not in ('', '0')
+
+
+class Metrics:
+
+    latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    size_buckets = [1e3, 1e4, 1e5, 1e6, 1e7, 1e8]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.help = {}
+        self.histograms = {}
+        self.counters = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = (buckets, [0] * len(buckets), [0.0, 0])
+            buckets, counts, total = self.histograms[key]
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            total[0] += value
+            total[1] += 1
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        ## adds the duration of the block to the phase of data loading
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc('trees_data_phase_seconds_total', {'phase': phase}, time.perf_counter() - start)
+
+    def render(self, values=()):
+
+        ## Prometheus text format, values: (name, labels, value) of metrics
+        ## which are only known when rendering, gauges unless described
+        ## otherwise. Backslash, double quote and line feed are escaped in
+        ## label values, backslash and line feed in help texts
+        def escape(text, quote=True):
+            text = str(text).replace('\\', '\\\\').replace('\n', '\\n')
+            return text.replace('"', '\\"') if quote else text
+
+        def fmt_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            return '{' + ','.join('{}="{}"'.format(key, escape(val)) for key, val in labels) + '}' if labels else ''
+
+        lines = []
+        def header(name, default_kind):
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.append('# HELP {} {}'.format(name, escape(text, quote=False)))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, (buckets, list(counts), list(total))) for key, (buckets, counts, total) in histograms]
+
+        current = None
+        for (name, labels), value in counters:
+            if name != current:
+                header(name, 'counter')
+                current = name
+            lines.append('{}{} {}'.format(name, fmt_labels(labels), value))
+
+        for (name, labels), (buckets, counts, total) in histograms:
+            if name != current:
+                header(name, 'histogram')
+                current = name
+            for bound, count in zip(buckets, counts):
+                lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, le=bound), count))
+            lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, le='+Inf'), total[1]))
+            lines.append('{}_sum{} {}'.format(name, fmt_labels(labels), total[0]))
+            lines.append('{}_count{} {}'.format(name, fmt_labels(labels), total[1]))
+
+        for name, labels, value in values:
+            if name != current:
+                header(name, 'gauge')
+                current = name
+            lines.append('{}{} {}'.format(name, fmt_labels(sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('trees_callback_duration_seconds', 'histogram', 'Duration of Dash callbacks')
+metrics.describe('trees_callback_errors_total', 'counter', 'Dash callbacks which raised an error')
+metrics.describe('trees_callback_request_bytes', 'histogram', 'Size of Dash callback requests')
+metrics.describe('trees_callback_response_bytes', 'histogram', 'Size of Dash callback responses')
+metrics.describe('trees_data_phase_seconds_total', 'counter',
+                 'Time spent in the phases of data loading, summed over parallel pages')
+metrics.describe('trees_cache_hits_total', 'counter', 'Hits of the server side caches')
+metrics.describe('trees_cache_misses_total', 'counter', 'Misses of the server side caches')
+metrics.describe('trees_jobs_total', 'counter',
+                 'Requested jobs, started or served by a running or finished job')
+
+
+def instrument_callbacks(register):
+
+    ## wraps app.callback, every callback registered afterwards is timed and
+    ## its errors are counted. The name is kept in flask.g for the payload
+    ## sizes measured after the request
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        def wrap(func):
+            name = func.__name__
+
+            @functools.wraps(func)
+            def timed_func(*func_args, **func_kwargs):
+                if flask.has_request_context():
+                    flask.g.callback_name = name
+                profiler = cProfile.Profile() if profile_slow_callbacks > 0 else None
+                start = time.perf_counter()
+                try:
+                    if profiler is not None:
+                        try:
+                            profiler.enable()
+                        except ValueError:
+                            ## another thread is profiling already
+                            profiler = None
+                    return func(*func_args, **func_kwargs)
+                except dash.exceptions.PreventUpdate:
+                    raise
+                except Exception:
+                    metrics.inc('trees_callback_errors_total', {'callback': name})
+                    raise
+                finally:
+                    duration = time.perf_counter() - start
+                    metrics.observe('trees_callback_duration_seconds', {'callback': name},
+                                    duration, Metrics.latency_buckets)
+                    if profiler is not None:
+                        profiler.disable()
+                        if duration > profile_slow_callbacks:
+                            dump_profile(profiler, name)
+
+            return decorator(timed_func)
+
+        return wrap
+
+    return callback
+
+
+def dump_profile(profiler, name):
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, '{}_{}.prof'.format(name, int(time.time() * 1000)))
+    profiler.dump_stats(path)
+    logger.info('Slow callback %s, profile written to %s', name, path)
+
+
+def get_app_token():
 
     ########################################################################
     # Insert personal app_token here. Alternatively, if you do not want your
@@ -58,285 +415,1961 @@ def get_data(data_limit=2000):
         except:
             token = ''
 
+    return token
+
+
+def make_client():
+
+    token = get_app_token()
+
+    ## an explicit http(s):// prefix in datasource is kept (local stand-in
+    ## server), otherwise https is used
+    prefix, domain = 'https://', datasource
+    if '://' in datasource:
+        scheme, domain = datasource.split('://', 1)
+        prefix = scheme + '://'
+    session_adapter = {'prefix': prefix,
+                       'adapter': requests.adapters.HTTPAdapter()}
+
     if token != '':
-        client = Socrata(datasource,token,timeout=timeout)
+        client = Socrata(domain, token, timeout=timeout, session_adapter=session_adapter)
     else:
-        client = Socrata(datasource, None, timeout=timeout)
+        client = Socrata(domain, None, timeout=timeout, session_adapter=session_adapter)
 
-    record_count_total = client.get(dataset, select="COUNT(*)")
-    record_count_total = int(record_count_total[0]['COUNT'])
+    return client
 
-    ## results_meta = client.get_metadata(dataset)
-    results = client.get(dataset, limit=data_limit)
-    client.close()
 
-    ## Convert to pandas DataFrame
-    df = pd.DataFrame.from_dict(results)
+def clean_data(df):
 
-    # make data types usable and consistent
-    df['tree_id']    = df['tree_id'].astype(int)
-    df['latitude']   = df['latitude'].astype(float)
-    df['longitude']  = df['longitude'].astype(float)
-    df['tree_dbh']   = df['tree_dbh'].astype(float)
-    df['stump_diam'] = df['stump_diam'].astype(float)
-    df['status']     = df['status'].astype(str)  # in order to handle NaN as 'nan'
-    df['health']     = df['health'].astype(str)
-    df['spc_latin']  = df['spc_latin'].astype(str)
-    df['spc_common'] = df['spc_common'].astype(str)
-    df['problems']   = df['problems'].astype(str)
+    ## Socrata leaves out keys with empty values. If a column is empty in the
+    ## whole page it is missing completely
+    for col in required_columns:
+        if col not in df:
+            df[col] = np.nan
 
-    ## replace small diameter values with higher values for visualization in a new column
-    df['tree_dbh_vis'] = df.tree_dbh
-    df.loc[df.status == 'Stump', 'tree_dbh_vis'] = df.stump_diam
-    df.loc[df.tree_dbh_vis < 5, 'tree_dbh_vis'] = 5
+    # make data types usable, consistent and compact
+    df['tree_id']    = df['tree_id'].astype('int32')
+    df['latitude']   = df['latitude'].astype('float32')
+    df['longitude']  = df['longitude'].astype('float32')
+    df['tree_dbh']   = pd.to_numeric(df['tree_dbh']).fillna(0).astype('int16')
+    df['stump_diam'] = pd.to_numeric(df['stump_diam']).fillna(0).astype('int16')
 
-    ## clipping of extremely large diameter
-    df.loc[df.tree_dbh_vis > 25, 'tree_dbh_vis'] = 25
+    ## replace small diameter values with higher values for visualization in
+    ## a new column, clipping of extremely large diameter
+    df['tree_dbh_vis'] = df.tree_dbh.where(df.status != 'Stump', df.stump_diam)
+    df['tree_dbh_vis'] = df.tree_dbh_vis.clip(5, 25).astype('uint8')
 
-    ## replace values - variant 1, using numpy.where (strange... but it works)
-    # df.spc_common = np.where(df.health == 'nan', df.status, df.spc_common)
-    ## replace NaN in health by status entries ('Stump' or 'Dead')
-    # df['health'] = np.where(df['health'] == 'nan', df['status'], df['health'])
+    ## replace missing species and health by status entries ('Stump' or 'Dead')
+    df['spc_common'] = df['spc_common'].fillna(df['status'])
+    df['health'] = df['health'].fillna(df['status'])
 
-    ## replace nan values with status entires - variant 2, use pandas.where
-    df.spc_common = df.status.where(df.spc_common == 'nan', df.spc_common)
-    df['health'] = df['status'].where(df['health'] == 'nan', df['health'])
+    for col in category_columns:
+        if col in df:
+            df[col] = df[col].astype('category')
 
-    return df, record_count_total
+    return df
 
 
-def create_mapbox_figure(df):
+def concat_frames(frames):
+
+    df = pd.concat(frames, ignore_index=True)
+
+    ## pd.concat falls back to object for categoricals with different
+    ## categories, merge the categories instead
+    for col in category_columns:
+        if col in df and df[col].dtype != 'category':
+            if all(col in frame for frame in frames):
+                df[col] = pd.api.types.union_categoricals(
+                    [frame[col] for frame in frames], ignore_order=True)
+            else:
+                df[col] = df[col].astype('category')
+
+    return df
+
+
+def log_memory_usage(df):
+
+    usage = df.memory_usage(index=False, deep=True).sort_values(ascending=False)
+    for col, size in usage.items():
+        logger.info('%-20s %-10s %8.2f MB', col, df[col].dtype, size / 1e6)
+    logger.info('DataFrame: %d rows, %d columns, %.1f MB in total',
+                len(df), df.shape[1], usage.sum() / 1e6)
+
+
+def count_rows(where=None):
+
+    with metrics.timed('count_query'), make_client() as client:
+        result = client.get(dataset, select="COUNT(*)", where=where)
+
+    return int(result[0]['COUNT'])
+
+
+def download_page(offset, limit, where=None):
+
+    ## a fixed order is required, otherwise pages might overlap. System
+    ## fields are included for :updated_at
+    select = None
+    if select_columns is not None:
+        columns = required_columns + [col for col in select_columns if col not in required_columns]
+        select = ','.join(columns + [':updated_at'])
+
+    for attempt in range(page_retries + 1):
+        try:
+            with metrics.timed('download'), make_client() as client:
+                results = client.get(dataset, select=select, where=where, order='tree_id',
+                                     limit=limit, offset=offset, exclude_system_fields=False)
+            break
+        except requests.exceptions.RequestException as e:
+            if attempt == page_retries:
+                raise
+            logger.warning('Page at offset %d failed (%s), retrying', offset, e)
+            time.sleep(2 ** attempt)
+
+    ## convert each page to typed columns as soon as it arrives
+    with metrics.timed('parse'):
+        df = pd.DataFrame.from_dict(results)
+    with metrics.timed('cleaning'):
+        return clean_data(df)
+
+
+def download_rows(row_count, where=None, on_page=None):
+
+    offsets = range(0, row_count, page_size)
+
+    ## on_page(page, pages_done, pages_total) is called for each finished page
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = [executor.submit(download_page, offset, min(page_size, row_count - offset), where)
+                   for offset in offsets]
+        for pages_done, future in enumerate(as_completed(futures), 1):
+            if on_page is not None:
+                on_page(future.result(), pages_done, len(futures))
+        pages = [future.result() for future in futures]
+
+    ## no rows (empty data set or data_limit 0): an empty frame with the
+    ## columns and types of the cleaned data
+    if not pages:
+        pages = [clean_data(pd.DataFrame(columns=required_columns))]
+
+    with metrics.timed('cleaning'):
+        df = concat_frames(pages)
+
+    ## keep the latest modification as snapshot time
+    updated_at = df[':updated_at'].max() if ':updated_at' in df else None
+
+    return drop_system_fields(df), updated_at
+
+
+def drop_system_fields(df):
+    ## :id, :created_at and :updated_at are only needed for the download
+    return df.drop(columns=[col for col in df.columns if col.startswith(':')])
+
+
+def data_name(data_limit):
+    ## name of the cached and shared data. Data of another source (e.g. the
+    ## stand-in server) or with other select_columns is kept apart
+    source = hashlib.sha1(json.dumps([datasource, select_columns]).encode('utf-8')).hexdigest()[:8]
+    return '{}_{}_v{}_{}'.format(dataset, data_limit, schema_version, source)
+
+
+def cache_paths(data_limit):
+    name = data_name(data_limit)
+    return os.path.join(cache_dir, name + '.feather'), os.path.join(cache_dir, name + '.json')
+
+
+def read_cache(data_limit):
+
+    data_path, meta_path = cache_paths(data_limit)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        df = pyarrow.feather.read_table(data_path, memory_map=True).to_pandas()
+    except (OSError, ValueError, pyarrow.ArrowException) as e:
+        logger.warning('Could not read cache %s (%s), downloading data', data_path, e)
+        return None
+
+    return df, meta
+
+
+def write_cache(df, meta, data_limit):
+
+    data_path, meta_path = cache_paths(data_limit)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    ## write to temporary files first, a crash while writing must not leave a
+    ## broken cache behind
+    df.to_feather(data_path + '.tmp', compression='uncompressed')
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def refresh_data(df, meta):
+
+    ## only download rows which were changed after the cached snapshot
+    where = ":updated_at > '{}'".format(meta['updated_at'])
+    df_updates, updated_at = download_rows(count_rows(where), where)
+
+    record_count_total = count_rows()
+    if len(df_updates) == 0:
+        return df, dict(meta, record_count_total=record_count_total)
+
+    ## if the cache holds only a part of the data set, keep to that part.
+    ## Otherwise new trees are added as well
+    if len(df) < meta['record_count_total']:
+        df_updates = df_updates.loc[df_updates.tree_id.isin(df.tree_id)]
+
+    df = concat_frames([df.loc[~df.tree_id.isin(df_updates.tree_id)], df_updates.reindex(columns=df.columns)])
+    df = df.sort_values('tree_id', ignore_index=True)
+
+    logger.info('Merged %d changed rows into cached data', len(df_updates))
+
+    return df, {'record_count_total': record_count_total,
+                'updated_at': max(meta['updated_at'], updated_at)}
+
+
+def get_data(data_limit=2000, refresh=False, on_page=None):
+
+    caching = use_cache and pyarrow is not None
+    with metrics.timed('cache_read'):
+        cached = read_cache(data_limit) if caching else None
+
+    if cached is not None:
+        df, meta = cached
+        if not refresh or meta['updated_at'] is None:
+            log_memory_usage(df)
+            return df, meta['record_count_total']
+        df, meta = refresh_data(df, meta)
+
+    else:
+        record_count_total = count_rows()
+
+        ## results_meta = client.get_metadata(dataset)
+        df, updated_at = download_rows(min(data_limit, record_count_total), on_page=on_page)
+        meta = {'record_count_total': record_count_total, 'updated_at': updated_at}
+
+    if caching:
+        with metrics.timed('cache_write'):
+            write_cache(df, meta, data_limit)
+
+    log_memory_usage(df)
+
+    return df, meta['record_count_total']
+
+
+def shared_paths(data_limit):
+    path = os.path.join(shared_dir, data_name(data_limit))
+    return path, os.path.join(path, 'meta.json')
+
+
+def write_table(df, path):
+
+    ## categoricals are stored as plain codes and numbers without null
+    ## bitmap (NaN stays NaN), both can be mapped without copying. Other
+    ## text columns are read as Arrow strings. Returns the categories
+    arrays, categories = [], {}
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            categories[col] = df[col].cat.categories.tolist()
+            arrays.append(pyarrow.array(df[col].cat.codes.to_numpy()))
+        elif df[col].dtype == object:
+            arrays.append(pyarrow.array(df[col].to_numpy(), type=pyarrow.string(), from_pandas=True))
+        else:
+            arrays.append(pyarrow.array(df[col].to_numpy()))
+    table = pyarrow.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+    pyarrow.feather.write_feather(table, path, compression='uncompressed')
+
+    return categories
+
+
+def read_table(path, categories):
+
+    ## numeric columns and category codes are views of the mapped file. The
+    ## frame is built in one step, assigning columns one by one would copy
+    table = pyarrow.feather.read_table(path, memory_map=True)
+    df = table.to_pandas(split_blocks=True, types_mapper={pyarrow.string(): pd.ArrowDtype(pyarrow.string())}.get)
+    columns = {col: pd.Categorical.from_codes(df[col].to_numpy(), categories=categories[col])
+               if col in categories else df[col] for col in df.columns}
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def write_cube(cube, path):
+
+    ## a cube (Series or DataFrame with a MultiIndex) as flat table, the
+    ## levels of the index as columns
+    series = isinstance(cube, pd.Series)
+    table = cube.to_frame('count') if series else cube
+    categories = write_table(table.reset_index(), path)
+
+    return {'dimensions': list(cube.index.names), 'categories': categories, 'series': series}
+
+
+def read_cube(path, meta):
+
+    ## the values are views of the mapped file, only the index is built
+    table = read_table(path, meta['categories'])
+    index = pd.MultiIndex.from_arrays([table[dim] for dim in meta['dimensions']])
+    if meta['series']:
+        return pd.Series(table['count'].to_numpy(), index=index, copy=False)
+    return pd.DataFrame({col: table[col].to_numpy() for col in table.columns if col not in meta['dimensions']},
+                        index=index, copy=False)
+
 
-    if df.count()[0] > 0:
-
-        health_status_selected = df['health'].unique().astype(str)
-
-        ## set legend entries in predefined order
-        category_orders = [
-            val for val in health_status_order if val in health_status_selected]
-
-
-        ## change color order to fit health status order
-        my_colors = px.colors.DEFAULT_PLOTLY_COLORS.copy()
-        my_colors[0] = px.colors.DEFAULT_PLOTLY_COLORS[2]  # 'Good' = green
-        my_colors[1] = px.colors.DEFAULT_PLOTLY_COLORS[0]  # 'Fair' = blue
-        my_colors[2] = px.colors.DEFAULT_PLOTLY_COLORS[1]  # 'Poor' = orange
-
-        ## set color values
-        color_discrete_sequence = [my_colors[idx] for idx, val in 
-            enumerate(health_status_order) if val in health_status_selected]
-
-        ## set hover data
-        hover_data = {'spc_latin': True,
-                      'health': True,
-                      'problems': True,
-                      'tree_dbh': True,
-                      'tree_dbh_vis': False,
-                      'latitude': False,
-                      'longitude': False,
-                      'tree_id': True,
-                      ## it is important to have tree_id on the last position
-                      ## for single tree identification in get_single_tree_data()
-                      }
-
-        fig = px.scatter_mapbox(df,
-                                lat="latitude",
-                                lon="longitude",
-                                hover_name='spc_common',
-                                hover_data=hover_data,
-                                color='health',
-                                category_orders={'health': category_orders},
-                                color_discrete_sequence=color_discrete_sequence,
-                                size='tree_dbh_vis',
-                                size_max=15,
-                                mapbox_style="carto-positron",
-                                height=1000,
-                                )
-        fig.update_layout(legend=dict(
-                          yanchor="top",
-                          y=0.99,
-                          xanchor="left",
-                          x=0.01
-                          ))
+def write_shared(df, record_count_total, path):
+
+    ## written to a new directory which replaces the old one, workers which
+    ## mapped the old files keep them until they attach to the new ones
+    tmp_path = tempfile.mkdtemp(dir=shared_dir)
+    categories = write_table(df, os.path.join(tmp_path, 'data.arrow'))
+
+    ## the indexes are derived once and shared as well
+    spatial = SpatialIndex(df['latitude'], df['longitude'], index_cell_size)
+    index_arrays = {'spatial_order': spatial.order, 'spatial_cells': spatial.cells}
+    tree_order = TreeIndex(df['tree_id']).order
+    if tree_order is not None:
+        index_arrays['tree_order'] = tree_order
+    index_arrays['species_order'] = SpeciesIndex(df[species_dimension], df['spc_latin']).order
+    for name, values in index_arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+
+    ## so are the cubes, see TreeData
+    stats_cube = StatsCube(df, stats_dimensions.values(), cube_dimensions)
+    grid_bins = GridBins(df, grid_resolutions, cube_dimensions)
+    cubes = {'count_cube': write_cube(CountCube(df, cube_dimensions + [species_dimension]).counts,
+                                      os.path.join(tmp_path, 'count_cube.arrow')),
+             'stats_cubes': {dim: write_cube(cube, os.path.join(tmp_path, 'stats_cube_{}.arrow'.format(dim)))
+                             for dim, cube in stats_cube.cubes.items()},
+             'grid_cubes': [write_cube(cube.counts, os.path.join(tmp_path, 'grid_cube_{}.arrow'.format(idx)))
+                            for idx, cube in enumerate(grid_bins.cubes)]}
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'record_count_total': record_count_total, 'categories': categories,
+                   'indexes': list(index_arrays), 'cubes': cubes, 'written_at': time.time()}, f)
+    if os.path.exists(path):
+        old_path = tempfile.mkdtemp(dir=shared_dir)
+        os.replace(path, os.path.join(old_path, 'data'))
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
     else:
-        ## show empty map
-        #category_orders = health_status_order
-        #color_discrete_sequence = my_colors
-        fig = px.scatter_mapbox(df,
-                                lat="latitude",
-                                lon="longitude",
-                                hover_name='spc_common',
-                                mapbox_style="carto-positron",
-                                height=1000)
-
-    ## this might help to remember maps position and zoom
+        os.replace(tmp_path, path)
+
+
+def read_shared(path):
+
+    ## map the shared files read-only, numeric columns, category codes, index
+    ## arrays and the values of the cubes are views of the mapped memory
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    df = read_table(os.path.join(path, 'data.arrow'), meta['categories'])
+
+    shared = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in meta['indexes']}
+
+    ## files written without cubes are still read, the cubes are computed then
+    cubes = meta.get('cubes')
+    if cubes:
+        shared['count_cube'] = read_cube(os.path.join(path, 'count_cube.arrow'), cubes['count_cube'])
+        shared['stats_cubes'] = {dim: read_cube(os.path.join(path, 'stats_cube_{}.arrow'.format(dim)), val)
+                                 for dim, val in cubes['stats_cubes'].items()}
+        shared['grid_cubes'] = [read_cube(os.path.join(path, 'grid_cube_{}.arrow'.format(idx)), val)
+                                for idx, val in enumerate(cubes['grid_cubes'])]
+
+    return df, meta, shared
+
+
+def get_shared_data(data_limit=2000, refresh=False, on_page=None):
+
+    ## the first worker gets the lock and writes the shared data, the other
+    ## workers wait for it. With refresh, the data is refreshed once by the
+    ## first worker started, not by every worker
+    os.makedirs(shared_dir, exist_ok=True)
+    path, meta_path = shared_paths(data_limit)
+
+    with open(os.path.join(shared_dir, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        written_at = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                written_at = json.load(f)['written_at']
+
+        if written_at is None or (refresh and written_at < process_start):
+            df, record_count_total = get_data(data_limit, refresh=refresh, on_page=on_page)
+            with metrics.timed('shared_write'):
+                write_shared(df, record_count_total, path)
+            del df
+
+    with metrics.timed('shared_read'):
+        df, meta, shared = read_shared(path)
+    log_memory_usage(df)
+
+    return df, meta['record_count_total'], shared
+
+
+def encode_array(values, dtype):
+    ## typed array in the format of the plotly.js typed array spec, base64
+    ## encoded. Decoded in the browser, see update_graph_mapbox_figure
+    values = np.ascontiguousarray(values, dtype=dtype)
+    return {'dtype': values.dtype.str[1:], 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+
+
+def health_color(val):
+
+    ## change color order to fit health status order
+    my_colors = px.colors.DEFAULT_PLOTLY_COLORS.copy()
+    my_colors[0] = px.colors.DEFAULT_PLOTLY_COLORS[2]  # 'Good' = green
+    my_colors[1] = px.colors.DEFAULT_PLOTLY_COLORS[0]  # 'Fair' = blue
+    my_colors[2] = px.colors.DEFAULT_PLOTLY_COLORS[1]  # 'Poor' = orange
+
+    idx = health_status_order.index(val) if val in health_status_order else len(health_status_order)
+    return my_colors[idx % len(my_colors)]
+
+
+def tree_slices(df):
+
+    ## positions of the trees of each borough and health status, health
+    ## status in predefined order, unexpected status at the end
+    groups = df.groupby([df['health'].astype(str), df['boroname'].astype(str)], sort=False).indices
+    rank = {val: idx for idx, val in enumerate(health_status_order)}
+    keys = sorted(groups, key=lambda key: (rank.get(key[0], len(rank)), key[0], key[1]))
+    return [(slice_uid(borough, val), borough, val, groups[(val, borough)]) for val, borough in keys]
+
+
+def slice_uid(borough, health):
+    return '{}|{}'.format(borough, health)
+
+
+def create_tree_trace(df, borough, health):
+
+    ## coordinates, marker sizes and tree_ids (customdata for
+    ## get_single_tree_data()) as typed arrays. Hover texts are loaded on
+    ## demand, see update_hover_text(). The uid identifies the trace when
+    ## traces are added or removed, see update_graph_mapbox()
+    return {'type': 'scattermapbox',
+            'uid': slice_uid(borough, health),
+            'name': borough,
+            'legendgroup': health,
+            'legendgrouptitle': {'text': health},
+            'lat': encode_array(df['latitude'], np.float32),
+            'lon': encode_array(df['longitude'], np.float32),
+            'customdata': encode_array(df['tree_id'], np.int32),
+            'marker': {'color': health_color(health),
+                       'size': encode_array(df['tree_dbh_vis'], np.uint8),
+                       ## marker area relates to tree_dbh_vis as in
+                       ## px.scatter_mapbox(size_max=15), tree_dbh_vis is at most 25
+                       'sizemode': 'area',
+                       'sizeref': 25 / 15 ** 2},
+            'mode': 'markers',
+            'hoverinfo': 'none',
+            }
+
+
+def create_mapbox_figure(df):
+
+    ## one trace per borough and health status
+    traces = [create_tree_trace(df.iloc[positions], borough, val)
+              for uid, borough, val, positions in tree_slices(df)] if len(df) > 0 else []
+
+    ## show empty map without trees
+    if not traces:
+        traces.append({'type': 'scattermapbox', 'lat': [], 'lon': [], 'mode': 'markers'})
+
+    ## uirevision might help to remember maps position and zoom
     ## still looking for better handling of new data and keeping
     ## user positions...
+    layout = {'mapbox': {'style': 'carto-positron', 'center': map_center, 'zoom': map_zoom},
+              'height': 1000,
+              'margin': {'t': 60},
+              'legend': {'yanchor': 'top', 'y': 0.99, 'xanchor': 'left', 'x': 0.01,
+                         'groupclick': 'toggleitem'},
+              'uirevision': 'my_setup'}
+
+    return {'data': traces, 'layout': layout}
+
+
+def create_grid_figure(counts):
+
+    ## counts: number of trees per grid cell (rows) and health status
+    ## (columns), plus the cell centers in 'latitude' and 'longitude'
+    health_columns = [val for val in counts.columns if val not in ('latitude', 'longitude')]
+    total = counts[health_columns].sum(axis=1)
+    unhealthy = counts[[val for val in health_columns if val in ('Poor', 'Dead', 'Stump')]].sum(axis=1)
+    unhealthy = 100 * unhealthy / total
+
+    text = ['<b>{} trees</b><br>'.format(n) + '<br>'.join(
+                '{}: {}'.format(val, row[idx]) for idx, val in enumerate(health_columns) if row[idx])
+            for n, row in zip(total, counts[health_columns].to_numpy())]
+
+    fig = go.Figure(go.Scattermapbox(
+        lat=counts['latitude'],
+        lon=counts['longitude'],
+        mode='markers',
+        marker=dict(size=6 + 24 * np.sqrt(total / total.max()),
+                    color=unhealthy,
+                    colorscale='RdYlGn_r',
+                    cmin=0,
+                    cmax=30,
+                    colorbar=dict(title='% Poor,<br>Dead,<br>Stump')),
+        text=text,
+        hoverinfo='text',
+        ))
+    fig.update_layout(mapbox=dict(style='carto-positron', center=map_center, zoom=map_zoom),
+                      margin=dict(t=60, b=0, l=0, r=0),
+                      height=1000)
+
+    ## same revision as in create_mapbox_figure(), keeps position and zoom
+    fig['layout']['uirevision'] = 'my_setup'
+
+    return fig
+
+
+def create_density_figure(density, res, zoom):
+
+    ## the smoothed grid is drawn as density layer, the radius covers about
+    ## one grid cell at the current zoom
+    radius = max(2, int(res * 256 * 2 ** zoom / 360))
+    fig = go.Figure(go.Densitymapbox(
+        lat=density['latitude'],
+        lon=density['longitude'],
+        z=density['density'],
+        radius=radius,
+        colorscale='YlOrRd',
+        colorbar=dict(title='Trees<br>per cell'),
+        hoverinfo='z',
+        ))
+    fig.update_layout(mapbox=dict(style='carto-positron', center=map_center, zoom=map_zoom),
+                      margin=dict(t=60, b=0, l=0, r=0),
+                      height=1000)
+
+    ## same revision as in create_mapbox_figure(), keeps position and zoom
     fig['layout']['uirevision'] = 'my_setup'
 
     return fig
 
 
+def zoom_level(zoom):
+
+    ## 'points' or index of the grid resolution for the map zoom level
+    if zoom >= lod_zoom:
+        return 'points'
+
+    ## mapbox tiles are 512 pixels wide for 360 degrees at zoom 0
+    cell_size = lod_cell_pixels * 360 / (512 * 2 ** zoom)
+    for idx, res in enumerate(grid_resolutions):
+        if res >= cell_size:
+            return idx
+
+    return len(grid_resolutions) - 1
+
+
+def view_bounds(relayout_data, zoom):
+
+    ## visible part of the map as [lat_min, lat_max, lon_min, lon_max]. The
+    ## corners are part of relayoutData, otherwise they are estimated from
+    ## center and zoom for a map of about 1200 x 1000 pixels
+    derived = relayout_data.get('mapbox._derived')
+    if derived and 'coordinates' in derived:
+        lon, lat = np.array(derived['coordinates'], dtype=float).T
+        return [float(lat.min()), float(lat.max()), float(lon.min()), float(lon.max())]
+
+    center = relayout_data.get('mapbox.center', map_center)
+    degrees_per_pixel = 360 / (512 * 2 ** zoom)
+    return [center['lat'] - 500 * degrees_per_pixel, center['lat'] + 500 * degrees_per_pixel,
+            center['lon'] - 600 * degrees_per_pixel, center['lon'] + 600 * degrees_per_pixel]
+
+
+def add_margin(bounds, margin):
+    lat_min, lat_max, lon_min, lon_max = bounds
+    dlat, dlon = (lat_max - lat_min) * margin, (lon_max - lon_min) * margin
+    return [lat_min - dlat, lat_max + dlat, lon_min - dlon, lon_max + dlon]
+
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and inner[1] <= outer[1] and outer[2] <= inner[2] and inner[3] <= outer[3]
+
+
+class SpatialIndex:
+
+    def __init__(self, lat, lon, cell_size, order=None, cells=None):
+
+        ## uniform grid over the coordinates, tree positions sorted by cell
+        self.lat = np.asarray(lat, dtype=np.float32)
+        self.lon = np.asarray(lon, dtype=np.float32)
+        self.cell_size = cell_size
+        ## without any coordinates a single empty cell at the map center
+        lat_range = ((np.nanmin(self.lat), np.nanmax(self.lat)) if not np.isnan(self.lat).all()
+                     else (map_center['lat'], map_center['lat']))
+        lon_range = ((np.nanmin(self.lon), np.nanmax(self.lon)) if not np.isnan(self.lon).all()
+                     else (map_center['lon'], map_center['lon']))
+        self.lat0 = float(lat_range[0])
+        self.lon0 = float(lon_range[0])
+        self.nrows = int((lat_range[1] - self.lat0) / cell_size) + 1
+        self.ncols = int((lon_range[1] - self.lon0) / cell_size) + 1
+
+        ## order and cells of shared data are computed already
+        if order is not None:
+            self.order, self.cells = order, cells
+            return
+
+        valid = ~(np.isnan(self.lat) | np.isnan(self.lon))
+        cells = np.full(len(self.lat), -1, dtype=np.int64)
+        cells[valid] = self.cell_row(self.lat[valid]) * self.ncols + self.cell_col(self.lon[valid])
+
+        self.order = np.argsort(cells, kind='stable').astype(np.int32)
+        self.cells = cells[self.order]
+
+    def cell_row(self, lat):
+        lat = np.asarray(lat, dtype=np.float64)
+        return np.clip(((lat - self.lat0) / self.cell_size).astype(np.int64), 0, self.nrows - 1)
+
+    def cell_col(self, lon):
+        lon = np.asarray(lon, dtype=np.float64)
+        return np.clip(((lon - self.lon0) / self.cell_size).astype(np.int64), 0, self.ncols - 1)
+
+    def query(self, lat_min, lat_max, lon_min, lon_max):
+
+        ## positions of all trees inside the box, in ascending order
+        rows = np.arange(self.cell_row(lat_min), self.cell_row(lat_max) + 1)
+        col_min, col_max = self.cell_col(lon_min), self.cell_col(lon_max)
+
+        ## the cells of one grid row are consecutive in self.cells
+        starts = np.searchsorted(self.cells, rows * self.ncols + col_min, side='left')
+        ends = np.searchsorted(self.cells, rows * self.ncols + col_max, side='right')
+        if len(rows) == 0 or (ends - starts).sum() == 0:
+            return np.empty(0, dtype=np.int32)
+        candidates = np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
 
+        lat = self.lat[candidates].astype(np.float64)
+        lon = self.lon[candidates].astype(np.float64)
+        inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+
+        return np.sort(candidates[inside])
+
+
+class TreeIndex:
+
+    def __init__(self, tree_id, order=None):
+
+        ## binary search over the sorted tree_ids. The data is downloaded
+        ## ordered by tree_id, usually no sort order needs to be kept
+        self.tree_id = np.asarray(tree_id)
+        if order is None and np.any(self.tree_id[1:] < self.tree_id[:-1]):
+            order = np.argsort(self.tree_id, kind='stable').astype(np.int32)
+        self.order = order
+        self.sorted_ids = self.tree_id if order is None else self.tree_id[order]
+
+    def get_indexer(self, tree_ids):
+
+        ## positions of the trees, -1 for unknown tree_ids
+        tree_ids = np.asarray(tree_ids, dtype=np.int64)
+        if len(self.sorted_ids) == 0:
+            return np.full(len(tree_ids), -1)
+        positions = np.searchsorted(self.sorted_ids, tree_ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == tree_ids
+        if self.order is not None:
+            positions = self.order[positions]
+        return np.where(found, positions, -1)
+
+
+class SpeciesIndex:
+
+    def __init__(self, common, latin, order=None):
+
+        ## row positions of each species: positions sorted by species, the
+        ## positions of one species are sorted as well
+        common = pd.Categorical(common)
+        codes = common.codes
+        names = list(common.categories.astype(str))
+        if order is None:
+            order = np.argsort(codes, kind='stable').astype(np.int32)
+        self.order = order
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        self.positions = {name: order[bounds[idx]:bounds[idx + 1]] for idx, name in enumerate(names)}
+        self.counts = {name: len(val) for name, val in self.positions.items()}
+        self.names = [name for name in names if self.counts[name] > 0]
+
+        ## the most frequent latin name of each species
+        pairs = pd.DataFrame({'common': common, 'latin': pd.Categorical(latin)}).value_counts()
+        pairs = pairs.reset_index().drop_duplicates('common')
+        self.latin = dict(zip(pairs['common'].astype(str), pairs['latin'].astype(str)))
+
+        ## prefix index: sorted (key, name) for the names and each of their
+        ## words in lower case, searched with bisect. Trigram index for
+        ## species containing the text
+        self.texts = {name: (name + ' ' + self.latin.get(name, '')).lower() for name in self.names}
+        self.keys = sorted({(key, name) for name, text in self.texts.items()
+                            for key in [name.lower(), self.latin.get(name, '').lower()] + text.split()})
+        self.trigrams = {}
+        for name, text in self.texts.items():
+            for idx in range(len(text) - 2):
+                self.trigrams.setdefault(text[idx:idx + 3], set()).add(name)
+
+    def search(self, text, limit):
+
+        ## species starting with text, then species containing it, most
+        ## trees first. All species for an empty text
+        text = ' '.join(text.lower().split())
+        by_count = lambda names: sorted(names, key=lambda name: -self.counts[name])
+        if not text:
+            return by_count(self.names)[:limit]
+
+        found = set()
+        for key, name in self.keys[bisect.bisect_left(self.keys, (text,)):]:
+            if not key.startswith(text):
+                break
+            found.add(name)
+        names = by_count(found)
+
+        if len(names) < limit and len(text) >= 3:
+            candidates = set.intersection(*[self.trigrams.get(text[idx:idx + 3], set())
+                                            for idx in range(len(text) - 2)])
+            names += by_count(name for name in candidates if name not in found and text in self.texts[name])
+
+        return names[:limit]
+
+    def positions_of(self, names):
+        ## sorted positions of the trees of all these species
+        arrays = [self.positions[name] for name in names if name in self.positions]
+        if not arrays:
+            return np.empty(0, dtype=np.int32)
+        return np.sort(np.concatenate(arrays)) if len(arrays) > 1 else arrays[0]
+
+
+def points_in_polygon(lat, lon, polygon):
+
+    ## even-odd rule, vectorized over the points, loop over the edges.
+    ## polygon: [[lon, lat], ...] as in plotly's lassoPoints
+    polygon = np.asarray(polygon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    inside = np.zeros(len(lat), dtype=bool)
+
+    for (lon1, lat1), (lon2, lat2) in zip(np.roll(polygon, 1, axis=0), polygon):
+        crosses = (lat1 > lat) != (lat2 > lat)
+        if lat1 != lat2:
+            lon_cross = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+            inside ^= crosses & (lon < lon_cross)
+
+    return inside
+
+
+def select_positions(data, geometry, mask):
+
+    ## positions of the trees in a box ('range') or lasso ('lassoPoints')
+    ## selection of the map, restricted to the filter mask
+    if geometry.get('range') and 'mapbox' in geometry['range']:
+        (lon1, lat1), (lon2, lat2) = geometry['range']['mapbox']
+        polygon = None
+    elif geometry.get('lassoPoints') and 'mapbox' in geometry['lassoPoints']:
+        polygon = np.asarray(geometry['lassoPoints']['mapbox'], dtype=np.float64)
+        (lon1, lat1), (lon2, lat2) = polygon.min(axis=0), polygon.max(axis=0)
+    else:
+        return np.empty(0, dtype=np.int32)
+
+    ## candidates from the bounding box
+    positions = data.spatial_index.query(min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2))
+    positions = positions[mask[positions]]
+
+    if polygon is not None:
+        inside = points_in_polygon(data.spatial_index.lat[positions], data.spatial_index.lon[positions], polygon)
+        positions = positions[inside]
+
+    return positions
+
+
+class CountCube:
+
+    def __init__(self, df, dimensions, counts=None):
+        self.dimensions = list(dimensions)
+        ## one entry for each combination of dimension values which exists.
+        ## counts of shared data are computed already
+        self.counts = counts if counts is not None else df.groupby(self.dimensions, observed=True).size()
+
+    def counts_by(self, dimension, selections=None):
+        ## counts for each value of dimension (or list of dimensions), where
+        ## the other dimensions are restricted to the values in selections,
+        ## e.g. {'health': ['Good']}
+        dimensions = dimension if isinstance(dimension, list) else [dimension]
+        counts = self.counts
+        for dim, values in (selections or {}).items():
+            if dim not in dimensions:
+                counts = counts[counts.index.get_level_values(dim).isin(values)]
+        return counts.groupby(level=dimension, observed=True).sum()
+
+
+class GridBins:
+
+    def __init__(self, df, resolutions, dimensions, counts=None):
+
+        ## one count cube of grid cell and dimensions for each resolution,
+        ## counts of shared data are computed already
+        self.lat0 = np.floor(df['latitude'].min())
+        self.lon0 = np.floor(df['longitude'].min())
+        self.resolutions = list(resolutions)
+        self.cubes = []
+        for idx, res in enumerate(self.resolutions):
+            if counts is not None:
+                self.cubes.append(CountCube(None, ['cell'] + list(dimensions), counts[idx]))
+                continue
+            cells = df[dimensions].assign(cell=self.cell_ids(df['latitude'], df['longitude'], res))
+            self.cubes.append(CountCube(cells, ['cell'] + list(dimensions)))
+
+    def cell_ids(self, lat, lon, res):
+        ## cells are numbered row by row, 1000 degrees per row is plenty
+        row = np.floor((np.asarray(lat, dtype=float) - self.lat0) / res).astype(np.int64)
+        col = np.floor((np.asarray(lon, dtype=float) - self.lon0) / res).astype(np.int64)
+        return row * int(np.ceil(1000 / res)) + col
+
+    def cell_centers(self, cells, res):
+        row, col = np.divmod(np.asarray(cells), int(np.ceil(1000 / res)))
+        return self.lat0 + (row + 0.5) * res, self.lon0 + (col + 0.5) * res
+
+    def aggregate(self, level, selections, max_cells, df=None):
+
+        ## use coarser resolutions until the number of cells is small enough.
+        ## Counts of selections beyond the cube dimensions (e.g. species) are
+        ## computed from the selected trees in df
+        for idx in range(level, len(self.resolutions)):
+            if df is None:
+                counts = self.cubes[idx].counts_by(['cell', 'health'], selections)
+            else:
+                cells = pd.Series(self.cell_ids(df['latitude'], df['longitude'], self.resolutions[idx]),
+                                  index=df.index, name='cell')
+                counts = df.groupby([cells, 'health'], observed=True).size()
+            counts = counts.unstack('health', fill_value=0)
+            if len(counts) <= max_cells:
+                break
+
+        ## health status in predefined order
+        counts.columns = counts.columns.astype(str)
+        counts = counts[[val for val in health_status_order if val in counts.columns] +
+                        [val for val in counts.columns if val not in health_status_order]]
+        counts['latitude'], counts['longitude'] = self.cell_centers(counts.index, self.resolutions[idx])
+
+        return counts
+
+
+class StatsCube:
+
+    def __init__(self, df, dimensions, slice_dimensions, cubes=None):
+
+        ## for each dimension: number of trees and sum and count of the
+        ## diameters (without stumps) per value, borough and health status.
+        ## cubes of shared data are computed already
+        if cubes is not None:
+            self.cubes = cubes
+            return
+        measures = pd.DataFrame({'trees': np.ones(len(df), dtype=np.int32),
+                                 'dbh_sum': df['tree_dbh'].to_numpy(dtype=np.int64),
+                                 'dbh_count': (df['tree_dbh'] > 0).to_numpy(dtype=np.int32)},
+                                index=df.index)
+        self.cubes = {}
+        for dim in dimensions:
+            if dim in df:
+                keys = [df[dim]] + [df[val] for val in slice_dimensions if val != dim]
+                self.cubes[dim] = measures.groupby(keys, observed=True).sum()
+
+    def statistics(self, dimension, selections=None):
+
+        ## one row per value of dimension, restricted to the values in
+        ## selections, e.g. {'boroname': ['Queens']}
+        cube = self.cubes[dimension]
+        for dim, values in (selections or {}).items():
+            if dim in cube.index.names:
+                cube = cube[cube.index.get_level_values(dim).isin(values)]
+
+        totals = cube.groupby(level=dimension, observed=True).sum()
+        by_health = cube['trees'].groupby(level=[dimension, 'health'], observed=True).sum()
+        by_health = by_health.unstack('health', fill_value=0)
+        by_health.columns = by_health.columns.astype(str)
+
+        stats = pd.DataFrame({'Trees': totals['trees']})
+        for val in health_status_order:
+            stats[val] = by_health[val] if val in by_health else 0
+        for val in ['Poor', 'Dead', 'Stump']:
+            stats['% ' + val] = (100 * stats[val] / stats['Trees']).round(1)
+        stats['Mean diameter'] = (totals['dbh_sum'] / totals['dbh_count'].where(totals['dbh_count'] > 0)).round(1)
+        stats = stats[stats['Trees'] > 0]
+        stats.index = stats.index.astype(str)
+
+        return stats
+
+
+def smooth(grid, sigma):
+
+    ## separable gaussian filter, one pass per axis over shifted copies
+    radius = int(np.ceil(3 * sigma))
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    kernel /= kernel.sum()
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        padded = np.pad(grid, padding)
+        size = grid.shape[axis]
+        grid = sum(weight * padded.take(np.arange(idx, idx + size), axis=axis)
+                   for idx, weight in enumerate(kernel))
+    return grid
+
+
+def compute_density(lat, lon, bounds, res, sigma):
+
+    ## smoothed tree counts per grid cell in the bounds (lat_min, lat_max,
+    ## lon_min, lon_max), as cell centers and values of the non-empty cells
+    lat_min, lat_max, lon_min, lon_max = bounds
+    lat_edges = lat_min + res * np.arange(int((lat_max - lat_min) / res) + 2)
+    lon_edges = lon_min + res * np.arange(int((lon_max - lon_min) / res) + 2)
+    counts, _, _ = np.histogram2d(lat, lon, bins=[lat_edges, lon_edges])
+    density = smooth(counts, sigma)
+
+    rows, cols = np.nonzero(density > density_min)
+    return pd.DataFrame({'latitude': lat_edges[rows] + res / 2,
+                         'longitude': lon_edges[cols] + res / 2,
+                         'density': density[rows, cols].astype(np.float32)})
+
+
+def make_borough_options(counts, borough_names):
+    options = [{'label': val + ' ({})'.format(counts.get(val, 0)), 'value': val} for val in borough_names]
+    return options
 
 
-def make_borough_options(df, borough_names):
-    options = [{'label': val + ' ({})'.format(sum(df.boroname == val)), 'value': val} for val in borough_names]
+def make_health_status_options(counts, health_status):
+    options = [{'label': val + ' ({})'.format(counts.get(val, 0)), 'value': val} for val in health_status]
     return options
 
 
-def make_health_status_options(df, health_status):
-    options = [{'label': val + ' ({})'.format(sum(df.health == val)), 'value': val} for val in health_status]
+def make_species_options(names, species_index):
+    ## common name, latin name and number of trees, e.g. pin oak, Quercus palustris (212)
+    options = [{'label': '{}, {} ({})'.format(val, species_index.latin.get(val, ''), species_index.counts.get(val, 0)),
+                'value': val} for val in names]
     return options
 
 
+def make_stats_dimension_options(data):
+    ## the statistics dimensions with a cube, a column projection (see
+    ## select_columns) leaves some out. Before loading, by the columns to be
+    ## downloaded
+    if data.stats_cube is not None:
+        available = data.stats_cube.cubes
+    elif select_columns is not None:
+        available = required_columns + select_columns
+    else:
+        available = stats_dimensions.values()
+    return [{'label': key, 'value': val} for key, val in stats_dimensions.items() if val in available]
+
 
-## get data
-df, record_count_total = get_data(data_limit)
-df_count = df.count()[0]
+class LRUCache:
 
-## create health_status filter options
-## although 'Alive' exists just once or so, probably errorneous entry
-health_status_order = ['Good', 'Fair', 'Poor', 'Dead', 'Stump']
-health_status_unique = df['health'].unique().astype(str)
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+
+        if compute is None:
+            return None
+
+        ## compute outside of the lock, concurrent misses for the same key
+        ## just compute the same value twice. Keys of data dependent values
+        ## contain the data version, a value computed from older data never
+        ## shows up under the key of the current data
+        value = compute()
+        self.put(key, value)
+
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+filter_cache = LRUCache(filter_cache_size)
+
+
+def make_filter_state(borough_name, health_status, species=None):
+
+    ## small JSON serializable description of the filter. The selections are
+    ## kept next to the key, so that any worker can recompute an evicted
+    ## entry. No species selection means all species
+    borough_name = sorted(borough_name or [])
+    health_status = sorted(health_status or [])
+    species = sorted(species or [])
+    selections = [borough_name, health_status] + ([species] if species else [])
+    key = hashlib.sha1(json.dumps(selections).encode('utf-8')).hexdigest()[:16]
+
+    return {'key': key, 'borough': borough_name, 'health': health_status, 'species': species}
+
+
+def filter_selections(filter_state):
+    ## selections of the filter state by count cube dimension
+    selections = {'boroname': filter_state['borough'], 'health': filter_state['health']}
+    if filter_state.get('species'):
+        selections[species_dimension] = filter_state['species']
+    return selections
+
+
+def compute_filter(data, filter_state):
 
-# 1. add known status elements first in order
-health_status = [
-    val for val in health_status_order if val in health_status_unique]
+    df = data.df
+    if not filter_state.get('species'):
+        mask = df['boroname'].isin(filter_state['borough']) & df['health'].isin(filter_state['health'])
+        return {'filtered': df.loc[mask], 'mask': mask.to_numpy()}
 
-# 2. add additional unexpected or new status elements at back
-health_status.extend(
-    [val for val in health_status_unique if val not in health_status_order])
+    ## only the trees of the selected species are checked for borough and
+    ## health status
+    positions = data.species_index.positions_of(filter_state['species'])
+    positions = positions[df['boroname'].iloc[positions].isin(filter_state['borough']).to_numpy() &
+                          df['health'].iloc[positions].isin(filter_state['health']).to_numpy()]
+    mask = np.zeros(len(df), dtype=bool)
+    mask[positions] = True
 
-## compare health status lists and give warning if unexpected elements in health_status_unique
-if set(health_status_unique) - set(health_status_order) != set():
-    print('Warning: Not all health status options covered:', set(health_status_unique) - set(health_status_order))
+    return {'filtered': df.iloc[positions], 'mask': mask}
 
-## create borough filter options
-borough_names = df['boroname'].unique()
-borough_names.sort()
+
+def resolve_filter(data, filter_state):
+    return filter_cache.get((data.version, filter_state['key']), lambda: compute_filter(data, filter_state))
+
+
+density_cache = LRUCache(density_cache_size)
+
+
+def compute_density_grid(data, filter_state, level):
+
+    ## density of the filtered trees, coarser resolutions until the number of
+    ## cells is small enough. The grid covers all trees, it is the same for
+    ## all filters
+    spatial_index = data.spatial_index
+    mask = resolve_filter(data, filter_state)['mask']
+    lat, lon = spatial_index.lat[mask], spatial_index.lon[mask]
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    bounds = (spatial_index.lat0, spatial_index.lat0 + spatial_index.nrows * spatial_index.cell_size,
+              spatial_index.lon0, spatial_index.lon0 + spatial_index.ncols * spatial_index.cell_size)
+    for idx in range(level, len(grid_resolutions)):
+        density = compute_density(lat[valid], lon[valid], bounds, grid_resolutions[idx], density_sigma)
+        if len(density) <= density_max_cells:
+            break
+    return density, grid_resolutions[idx]
+
+
+def resolve_density(data, filter_state, level):
+
+    ## computed by a job, see JobQueue. The key of the job and the density
+    ## grid, None while the job is running
+    cache_key = (data.version, filter_state['key'], level)
+    density = density_cache.get(cache_key)
+    if density is not None:
+        return None, density
+    key = job_queue.submit('density', {'filter_state': filter_state, 'level': level})
+    density = job_queue.poll(key)
+    if density is not None:
+        density_cache.put(cache_key, density)
+    return key, density
+
+
+selection_cache = LRUCache(selection_cache_size)
+
+
+def make_selection(geometry, filter_state):
+
+    ## small JSON serializable description of a graphical selection. Like the
+    ## filter state, the geometry and the filter are kept next to the key, so
+    ## that any worker can recompute an evicted entry
+    key = hashlib.sha1(json.dumps([geometry, filter_state['key']]).encode('utf-8')).hexdigest()[:16]
+
+    return {'key': key, 'geometry': geometry, 'filter_state': filter_state}
+
+
+def resolve_selection(data, selection):
+    ## positions of the selected trees, from the cache if possible
+    return selection_cache.get((data.version, selection['key']), lambda: select_positions(
+        data, selection['geometry'], resolve_filter(data, selection['filter_state'])['mask']))
+
+
+def export_chunks(data, positions):
+
+    ## the export is built chunk by chunk, never as a whole. At least one
+    ## (maybe empty) chunk for the header
+    df = data.df
+    columns = [col for col in df.columns if col != 'tree_dbh_vis']
+    for start in range(0, max(len(positions), 1), export_chunk_size):
+        yield df.iloc[positions[start:start + export_chunk_size]][columns]
+
+
+def stream_csv(chunks, compress=False):
+
+    compressor = zlib.compressobj(wbits=31) if compress else None  # gzip format
+    for idx, chunk in enumerate(chunks):
+        data = chunk.to_csv(header=idx == 0).encode('utf-8')
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def write_xlsx(chunks, path):
+
+    import openpyxl
+
+    ## write only mode, rows are not kept in memory
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet_1')
+    for idx, chunk in enumerate(chunks):
+        if idx == 0:
+            sheet.append([None] + list(chunk.columns))
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for row in values.itertuples(name=None):
+            sheet.append(row)
+    workbook.save(path)
+
+
+def export_positions(data, scope, filter_state=None, selection=None):
+    ## positions of the exported trees
+    if scope == 'all':
+        return np.arange(data.df_count)
+    if scope == 'filtered':
+        return np.flatnonzero(resolve_filter(data, filter_state)['mask'])
+    return resolve_selection(data, selection)
+
+
+def export_filename(scope, fmt, compress=False):
+    filename = 'StreetTreesOfNYC' + ('' if scope == 'all' else '_' + scope)
+    return filename + ('.csv.gz' if fmt == 'csv' and compress else '.' + fmt)
+
+
+def export_mimetype(fmt, compress=False):
+    if fmt == 'xlsx':
+        return 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return 'application/gzip' if compress else 'text/csv'
+
+
+tree_cache = LRUCache(tree_cache_size)
+
+
+def lookup_trees(data, tree_ids):
+    ## positions of the trees in df, -1 for unknown tree_ids
+    return data.tree_index.get_indexer(tree_ids)
+
+
+def tree_records(data, position):
+
+    ## all data of a single tree as trait/value records for the DataTable,
+    ## without tree_dbh_vis
+    row = data.df.iloc[position]
+    return [{'Value': None if pd.isna(val) else val, 'Trait': col}
+            for col, val in row.items() if col != 'tree_dbh_vis']
+
+
+def get_tree_records(data, tree_ids):
+
+    ## records for each known tree_id, from the cache if possible
+    records = {}
+    if data.df is None:
+        return records
+    for tree_id, position in zip(tree_ids, lookup_trees(data, tree_ids)):
+        if position >= 0:
+            records[tree_id] = tree_cache.get((data.version, tree_id), lambda: tree_records(data, position))
+    return records
+
+
+def json_response(data, status=200):
+    return flask.Response(json.dumps(data, cls=PlotlyJSONEncoder), status=status,
+                          mimetype='application/json')
+
+
+def export_url(scope, fmt, filter_state=None, selection=None, compress=False):
+
+    ## a selection is exported with the filter it was made with
+    params = []
+    if selection:
+        filter_state = selection['filter_state']
+        params.append(('selection', json.dumps(selection['geometry'], separators=(',', ':'))))
+    if filter_state:
+        params += [('borough', val) for val in filter_state['borough']]
+        params += [('health', val) for val in filter_state['health']]
+        params += [('species', val) for val in filter_state.get('species', [])]
+    if compress and fmt == 'csv':
+        params.append(('gzip', '1'))
+
+    url = app.get_relative_path('/export/{}.{}'.format(scope, fmt))
+    return url + ('?' + urlencode(params) if params else '')
+
+
+def write_job_file(path, filename, write, mode='w'):
+
+    ## written to a unique temporary file first, concurrent writers (e.g. the
+    ## same job started by two processes) don't write into the same file and
+    ## readers only see complete files
+    fd, tmp_path = tempfile.mkstemp(dir=path, prefix=filename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, os.path.join(path, filename))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def write_job_status(path, state, progress=0, error=None):
+    status = {'state': state, 'progress': progress, 'error': error, 'updated': time.time()}
+    write_job_file(path, 'status.json', lambda f: json.dump(status, f))
+
+
+def report_progress(chunks, count, progress):
+    for idx, chunk in enumerate(chunks):
+        progress(min(idx * export_chunk_size / max(count, 1), 1))
+        yield chunk
+
+
+def export_job(params, path, progress):
+
+    ## positions of a graphical selection come with the job, the selection
+    ## cache of a job process is empty
+    data = tree_data
+    positions = params.get('positions')
+    if positions is None:
+        positions = export_positions(data, params['scope'], params.get('filter_state'))
+    filename = export_filename(params['scope'], params['fmt'], params['compress'])
+    chunks = report_progress(export_chunks(data, positions), len(positions), progress)
+
+    if params['fmt'] == 'csv':
+        with open(os.path.join(path, filename), 'wb') as f:
+            for data in stream_csv(chunks, params['compress']):
+                f.write(data)
+    else:
+        write_xlsx(chunks, os.path.join(path, filename))
+
+    return {'file': filename, 'mimetype': export_mimetype(params['fmt'], params['compress'])}
+
+
+def density_job(params, path, progress):
+    return compute_density_grid(tree_data, params['filter_state'], params['level'])
+
+
+def statistics_job(params, path, progress):
+
+    ## the cubes don't cover species, statistics of a species selection are
+    ## computed from its trees
+    data = tree_data
+    filter_state = params['filter_state']
+    if filter_state.get('species'):
+        filtered = resolve_filter(data, filter_state)['filtered']
+        return StatsCube(filtered, [params['dimension']], cube_dimensions).statistics(params['dimension'])
+    return data.stats_cube.statistics(params['dimension'], filter_selections(filter_state))
+
+
+job_kinds = {'export': export_job, 'density': density_job, 'statistics': statistics_job}
+
+
+def run_job(kind, params, path):
+
+    ## runs in a job process (or thread), status and result are written to
+    ## path, the result as pickle
+    try:
+        write_job_status(path, 'running')
+        result = job_kinds[kind](params, path, lambda value: write_job_status(path, 'running', value))
+        write_job_file(path, 'result.pkl', lambda f: pickle.dump(result, f), 'wb')
+        write_job_status(path, 'done', 1)
+    except Exception as e:
+        write_job_status(path, 'failed', error=str(e))
+        raise
+
+
+def init_job_worker(path):
+
+    ## job processes map the shared data once, they don't load a copy
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    data, meta, shared = read_shared(path)
+    init_data(data, meta['record_count_total'], shared)
+    load_state['status'] = 'ready'
+
+
+class JobQueue:
+
+    def __init__(self, workers, path):
+        self.workers = workers
+        self.path = os.path.abspath(path)
+        self.source = None
+        self.tag = None
+        self.executor = None
+        self.runner = None
+        self.futures = {}
+        self._lock = threading.RLock()
+
+    def configure(self, source=None):
+
+        ## source: ('cache', data_limit) or ('shared', path) of the data in
+        ## use, None for data of this process only. Nothing is started before
+        ## the first job
+        with self._lock:
+            self.stop()
+            self.source = source
+
+            ## results are valid for the same data. Processes using the same
+            ## files share their results
+            if source is None:
+                self.tag = '{}-{}'.format(os.getpid(), tree_data.version)
+            else:
+                path = (os.path.join(source[1], 'meta.json') if source[0] == 'shared'
+                        else cache_paths(source[1])[0])
+                self.tag = '{}-{}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+    def shared(self):
+        ## jobs of shared data run in the job processes of the host
+        return self.source is not None and self.source[0] == 'shared' and self.workers > 0
+
+    def stop(self):
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            if self.runner is not None:
+                self.runner.close()
+            self.executor = None
+            self.runner = None
+            self.source = None
+            self.tag = None
+            self.futures = {}
+
+    def submit(self, kind, params, data=None):
+
+        ## key of the job. Identical requests share a running job or reuse
+        ## the finished result. data is passed to the job as well, it must
+        ## be determined by params
+        with self._lock:
+            if self.tag is None:
+                self.configure()
+            key = hashlib.sha1(json.dumps([kind, params, self.tag], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+            ## running here or in another process
+            future = self.futures.get(key)
+            status = self.status(key)
+            if (future is not None and not future.done()) or self.running_elsewhere(key, status):
+                metrics.inc('trees_jobs_total', {'kind': kind, 'job': 'running'})
+                return key
+            if status['state'] == 'done' and status['updated'] > time.time() - job_max_age:
+                metrics.inc('trees_jobs_total', {'kind': kind, 'job': 'finished'})
+                return key
+
+            self.cleanup()
+            path = os.path.join(self.path, key)
+            os.makedirs(path, exist_ok=True)
+            params = dict(params, **(data or {}))
+            if self.shared():
+                ## queued for the job processes of the host
+                write_job_file(path, 'params.pkl', lambda f: pickle.dump((kind, params), f), 'wb')
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(path, 'claimed'))
+                write_job_status(path, 'queued')
+                self.dispatch()
+            else:
+                write_job_status(path, 'queued')
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max(self.workers, 1), thread_name_prefix='job')
+                self.futures[key] = self.executor.submit(run_job, kind, params, path)
+            metrics.inc('trees_jobs_total', {'kind': kind, 'job': 'started'})
+
+        return key
+
+    def dispatch(self):
+
+        ## the first process which takes the lock of job_dir starts the job
+        ## processes of the host and runs the queued jobs of all processes.
+        ## The lock is released with the process, the next process with a
+        ## job takes over
+        with self._lock:
+            if self.executor is None:
+                os.makedirs(self.path, exist_ok=True)
+                runner = open(os.path.join(self.path, 'runner.lock'), 'w')
+                try:
+                    fcntl.flock(runner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    runner.close()
+                    return
+                self.runner = runner
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_job_worker, initargs=(self.source[1],))
+                ## queued jobs claimed by an earlier pool are not run by anyone
+                for key in self.queued(claimed=True):
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(self.path, key, 'claimed'))
+                threading.Thread(target=self.run_queued, args=(self.executor,), name='job_dispatch',
+                                 daemon=True).start()
+            self.claim_queued()
+
+    def run_queued(self, executor):
+        ## queued jobs of other processes, until the pool is stopped
+        while self.executor is executor:
+            time.sleep(job_wait_interval)
+            with contextlib.suppress(OSError):
+                self.claim_queued()
+
+    def queued(self, claimed=False):
+        ## keys of the queued jobs in job_dir, claimed or not
+        if not os.path.isdir(self.path):
+            return []
+        return [key for key in os.listdir(self.path)
+                if os.path.exists(os.path.join(self.path, key, 'params.pkl'))
+                and os.path.exists(os.path.join(self.path, key, 'claimed')) == claimed
+                and self.status(key)['state'] == 'queued']
+
+    def claim_queued(self):
+
+        ## submit the queued jobs to the job processes. A claimed job is not
+        ## submitted again, unless it gets stale and is queued again
+        with self._lock:
+            executor = self.executor
+            if executor is None or self.runner is None:
+                return
+            for key in self.queued():
+                path = os.path.join(self.path, key)
+                try:
+                    os.close(os.open(os.path.join(path, 'claimed'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    with open(os.path.join(path, 'params.pkl'), 'rb') as f:
+                        kind, params = pickle.load(f)
+                except OSError:
+                    continue
+                try:
+                    self.futures[key] = executor.submit(run_job, kind, params, path)
+                except BrokenProcessPool:
+                    logger.warning('Job processes failed, starting new ones')
+                    self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                        initializer=init_job_worker, initargs=(self.source[1],))
+                    self.futures[key] = self.executor.submit(run_job, kind, params, path)
+                    threading.Thread(target=self.run_queued, args=(self.executor,), name='job_dispatch',
+                                     daemon=True).start()
+                    executor = self.executor
+
+    def status(self, key):
+
+        ## read from disk, jobs of other processes are seen as well
+        try:
+            with open(os.path.join(self.path, key, 'status.json')) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            return {'state': 'unknown', 'progress': 0, 'error': None, 'updated': 0}
+
+        ## e.g. a crashed job process
+        future = self.futures.get(key)
+        if status['state'] != 'failed' and future is not None and future.done() and future.exception() is not None:
+            status.update(state='failed', error=str(future.exception()) or type(future.exception()).__name__)
+        return status
+
+    def running_elsewhere(self, key, status):
+        ## queued or running in another process, with a recent status
+        return (key not in self.futures and status['state'] in ('queued', 'running')
+                and status['updated'] > time.time() - job_stale_after)
+
+    def result(self, key):
+        with open(os.path.join(self.path, key, 'result.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def poll(self, key):
+
+        ## result of a finished job, None while it is queued or running. A
+        ## job of shared data is handed to the job processes, if the process
+        ## which ran them is gone
+        status = self.status(key)
+        if status['state'] in ('queued', 'running'):
+            if self.shared() and status['state'] == 'queued':
+                self.dispatch()
+            return None
+        if status['state'] != 'done':
+            raise RuntimeError('Job {} {}: {}'.format(key, status['state'], status['error']))
+        return self.result(key)
+
+    def wait(self, key):
+
+        ## blocks until the job is done, e.g. in scripts. The app polls
+        while True:
+            future = self.futures.get(key)
+            if future is not None:
+                future.result()
+            status = self.status(key)
+            if not self.running_elsewhere(key, status):
+                break
+            if self.shared() and status['state'] == 'queued':
+                self.dispatch()
+            time.sleep(job_wait_interval)
+        if self.poll(key) is None:
+            raise RuntimeError('Job {} was lost'.format(key))
+
+    def cleanup(self):
+
+        ## remove finished futures and results older than job_max_age
+        with self._lock:
+            self.futures = {key: future for key, future in self.futures.items() if not future.done()}
+            if not os.path.isdir(self.path):
+                return
+            limit = time.time() - job_max_age
+            for key in os.listdir(self.path):
+                if not os.path.isdir(os.path.join(self.path, key)):
+                    continue
+                try:
+                    expired = os.path.getmtime(os.path.join(self.path, key, 'status.json')) < limit
+                except OSError:
+                    expired = True
+                if expired and key not in self.futures:
+                    shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+
+job_queue = JobQueue(job_workers, job_dir)
+
+
+client_data_cache = LRUCache(1)
+
+
+def make_client_data(data):
+
+    ## compact columns for client mode, see assets/clientside.js. Borough and
+    ## health status as codes (-1 for missing), the layout of the map and
+    ## the trace colors as in create_mapbox_figure()
+    df, borough_names, health_status = data.df, data.borough_names, data.health_status
+    borough_codes = pd.Categorical(df['boroname'].astype(str), categories=borough_names).codes
+    health_codes = pd.Categorical(df['health'].astype(str), categories=health_status).codes
+    return {'tree_id': encode_array(df['tree_id'], np.int32),
+            'lat': encode_array(df['latitude'], np.float32),
+            'lon': encode_array(df['longitude'], np.float32),
+            'borough': encode_array(borough_codes, np.int8),
+            'health_code': encode_array(health_codes, np.int8),
+            'size': encode_array(df['tree_dbh_vis'], np.uint8),
+            'boroughs': list(borough_names),
+            'health': list(health_status),
+            'colors': [health_color(val) for val in health_status],
+            'sizeref': 25 / 15 ** 2,
+            'layout': create_mapbox_figure(df.iloc[:0])['layout'],
+            'stats': make_client_stats(data)}
+
+
+def make_client_stats(data):
+
+    ## the statistics cubes for client mode: for each dimension its values
+    ## and, per row of the cube, the codes of value, borough and health
+    ## status with the measures. Sliced like StatsCube.statistics()
+    cubes = {}
+    for dim, cube in data.stats_cube.cubes.items():
+        rows = cube.reset_index()
+        codes, values = pd.factorize(rows[dim], sort=True)
+        cubes[dim] = {'values': list(pd.Index(values).astype(str)),
+                      'value': encode_array(codes, np.int32),
+                      'borough': encode_array(pd.Categorical(rows['boroname'].astype(str),
+                                                             categories=data.borough_names).codes, np.int8),
+                      'health': encode_array(pd.Categorical(rows['health'].astype(str),
+                                                            categories=data.health_status).codes, np.int8),
+                      'trees': encode_array(rows['trees'], np.int32),
+                      'dbh_sum': encode_array(rows['dbh_sum'], np.float64),
+                      'dbh_count': encode_array(rows['dbh_count'], np.int32)}
+    return {'cubes': cubes,
+            'labels': {val: key for key, val in stats_dimensions.items()},
+            'health_order': health_status_order,
+            'min_trees': stats_min_trees,
+            'bar_count': stats_bar_count,
+            'layout': create_stats_figure(pd.Series(dtype=float), '').to_plotly_json()['layout']}
+
+
+class TreeData:
+
+    ## the data used by the app and everything derived from it, built at once
+    ## and never changed afterwards. init_data() publishes a new TreeData in
+    ## a single assignment. Callbacks take tree_data once and use only that
+    ## object, they never see parts of two different data sets. The index
+    ## arrays and cubes of shared data (see read_shared) replace their
+    ## computation
+    def __init__(self, df=None, record_count_total=None, version=0, shared=None):
+
+        self.df = df
+        self.record_count_total = record_count_total
+        self.version = version
+        self.df_count = None if df is None else len(df)
+        self.health_status = self.borough_names = []
+        self.count_cube = self.stats_cube = self.grid_bins = None
+        self.spatial_index = self.tree_index = self.species_index = None
+        if df is None:
+            return
+        shared = shared or {}
+
+        ## create health_status filter options
+        ## although 'Alive' exists just once or so, probably errorneous entry
+        health_status_unique = df['health'].unique().astype(str)
+
+        # 1. add known status elements first in order
+        self.health_status = [
+            val for val in health_status_order if val in health_status_unique]
+
+        # 2. add additional unexpected or new status elements at back
+        self.health_status.extend(
+            [val for val in health_status_unique if val not in health_status_order])
+
+        ## compare health status lists and give warning if unexpected elements in health_status_unique
+        if set(health_status_unique) - set(health_status_order) != set():
+            print('Warning: Not all health status options covered:', set(health_status_unique) - set(health_status_order))
+
+        ## create borough filter options
+        self.borough_names = sorted(df['boroname'].dropna().unique())
+
+        ## count cube for the checklist labels, also by species
+        self.count_cube = CountCube(df, cube_dimensions + [species_dimension], shared.get('count_cube'))
+
+        ## district statistics
+        self.stats_cube = StatsCube(df, stats_dimensions.values(), cube_dimensions, shared.get('stats_cubes'))
+
+        ## aggregated trees for the zoomed out map
+        self.grid_bins = GridBins(df, grid_resolutions, cube_dimensions, shared.get('grid_cubes'))
+
+        ## spatial index for the visible part of the map
+        self.spatial_index = SpatialIndex(df['latitude'], df['longitude'], index_cell_size,
+                                          shared.get('spatial_order'), shared.get('spatial_cells'))
+
+        ## index for single trees
+        self.tree_index = TreeIndex(df['tree_id'], shared.get('tree_order'))
+
+        ## trees and search index of each species
+        self.species_index = SpeciesIndex(df[species_dimension], df['spc_latin'], shared.get('species_order'))
+
+
+def init_data(data, record_count, shared=None):
+
+    ## set the data used by the app. Everything derived from it is built
+    ## first and swapped in at the end, callbacks running meanwhile still use
+    ## the previous data
+    global tree_data
+    tree_data = TreeData(data, record_count, tree_data.version + 1, shared)
+
+    ## cached results and running jobs refer to the previous data
+    for cache in (filter_cache, density_cache, selection_cache, tree_cache):
+        cache.clear()
+    job_queue.stop()
+
+
+## nothing is loaded yet, the callbacks show an empty map until the data
+## version changes. load_state tells the browser about the progress of
+## load_data()
+tree_data = TreeData()
+load_state = {'status': 'loading', 'pages_done': 0, 'pages_total': None, 'error': None}
+data_ready = threading.Event()
+preview_lock = threading.Lock()
+
+
+def show_preview(page, pages_done, pages_total):
+
+    ## show the first finished page while the other pages are downloaded
+    load_state.update(pages_done=pages_done, pages_total=pages_total)
+    with preview_lock:
+        if tree_data.df is None and pages_done < pages_total:
+            init_data(drop_system_fields(page), None)
+
+
+def load_data():
+
+    try:
+        with metrics.timed('get_data'):
+            if shared_dir:
+                data = get_shared_data(data_limit, refresh=cache_refresh, on_page=show_preview)
+            else:
+                data = get_data(data_limit, refresh=cache_refresh, on_page=show_preview)
+        with metrics.timed('init_data'):
+            init_data(*data)
+
+        ## processes using the same files share their job results, with
+        ## shared data the job processes map these files
+        if shared_dir:
+            job_queue.configure(('shared', shared_paths(data_limit)[0]))
+        elif use_cache and pyarrow is not None:
+            job_queue.configure(('cache', data_limit))
+        load_state['status'] = 'ready'
+    except Exception as e:
+        logger.exception('Loading the data failed')
+        load_state.update(status='failed', error=str(e))
+    finally:
+        data_ready.set()
+
+
+def wait_for_data(timeout=None):
+    ## True if the data is loaded, e.g. for scripts importing this module
+    data_ready.wait(timeout)
+    return load_state['status'] == 'ready'
+
+
+def load_text():
+
+    data = tree_data
+    if load_state['status'] == 'ready':
+        text = 'The NYC 2015 Street Tree Census counts {} entries in total. Entries shown in this application: {}'.format(
+            data.record_count_total, data.df_count)
+    elif load_state['status'] == 'failed':
+        text = 'Loading the data failed: {}'.format(load_state['error'])
+    elif load_state['pages_total']:
+        text = 'Loading data, {} of {} pages done.'.format(load_state['pages_done'], load_state['pages_total'])
+        if data.df is not None:
+            text += ' Showing the first {} entries meanwhile.'.format(data.df_count)
+    else:
+        text = 'Loading data...'
+
+    return '''
+           {}
+
+           Data from here: [NYC OpenData 2015 Street Tree Census](https://data.cityofnewyork.us/Environment/2015-Street-Tree-Census-Tree-Data/uvpi-gqnh)
+           '''.format(text)
+
+
+loader = None
+loader_lock = threading.Lock()
+
+
+def start_loading():
+
+    ## get data in the background, once per process. Called by the __main__
+    ## block, by gunicorn's post_fork hook (see gunicorn.conf.py) and at the
+    ## latest by the first request. Importing the module alone doesn't load
+    ## anything, e.g. in job processes, which get their data from
+    ## init_job_worker()
+    global loader
+    with loader_lock:
+        if loader is None:
+            loader = threading.Thread(target=load_data, name='load_data', daemon=True)
+            loader.start()
 
 ## set up app
 external_stylesheets=['https://codepen.io/chriddyp/pen/bWLwgP.css']
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets, title='Street Trees', prevent_initial_callbacks=False)
+## with flask_compress installed, responses are gzip (or brotli) compressed
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets, title='Street Trees', prevent_initial_callbacks=False,
+                compress=flask_compress is not None)
+app.callback = instrument_callbacks(app.callback)
 
-app.layout = html.Div([ 
-    
-    html.Div([ # main row
+## WSGI application for gunicorn, e.g. gunicorn -w 4 trees_of_nyc:server
+server = app.server
+
+
+## other WSGI servers start loading with the first request
+@app.server.before_request
+def start_loading_on_request():
+    if loader is None:
+        start_loading()
 
-        html.Div([ # first column, width 8
 
-            html.H1(children='Hello Street Trees of New York City'),
+def callback_if(condition, *args, **kwargs):
+    ## app.callback only if condition is true, e.g. for the callbacks which
+    ## run in the browser in client mode. The function stays usable anyway
+    if condition:
+        return app.callback(*args, **kwargs)
+    return lambda func: func
 
-            dcc.Markdown('''
-                     The NYC 2015 Street Tree Census counts {} entries in total. Entries shown in this application: {}
+## the layout is built for every page load, it shows the data loaded so far
+def serve_layout():
+
+    data = tree_data
+    return html.Div([ 
     
-                     Data from here: [NYC OpenData 2015 Street Tree Census](https://data.cityofnewyork.us/Environment/2015-Street-Tree-Census-Tree-Data/uvpi-gqnh)
-                     '''.format(record_count_total, df_count)),
+        html.Div([ # main row
 
+            html.Div([ # first column, width 8
 
-            ## Map for visualization
-            dcc.Loading(id='loading_1', type='default',
-                        children = dcc.Graph(id='graph_mapbox')),
+                html.H1(children='Hello Street Trees of New York City'),
 
-            html.Div([ # column
+                dcc.Markdown(load_text(), id='text_load'),
 
-                html.Div([
+                ## polls the progress while the data is loading
+                dcc.Interval(id='interval_load', interval=load_poll_interval,
+                             disabled=load_state['status'] != 'loading'),
+                dcc.Store(id='store_data_version', data=data.version),
 
-                    ## Checklist for selecting Boroughs
-                    html.H3('Borough'),
-                    dcc.Checklist(id='checklist_borough',
-                                   # make checklist with total number of elements in each category like, e.g.: Queens (212)
-                                   options=make_borough_options(df, borough_names),
-                                   value=['Brooklyn']),
 
-                ], className='three columns'),
+                ## Map for visualization, single trees or density of the
+                ## filtered trees
+                dcc.RadioItems(id='radio_map_mode',
+                               options=[{'label': 'Trees', 'value': 'trees'},
+                                        {'label': 'Density (e.g. of Poor, Dead and Stump trees)', 'value': 'density'}],
+                               value='trees',
+                               labelStyle={'display': 'inline-block', 'margin-right': '1em'},
+                               ## no density in client mode
+                               style={'display': 'none'} if client_mode else None),
 
+                ## details of the tree under the mouse pointer
+                html.Div(id='text_hover', style={'min-height': '1.5em'}),
+
+                dcc.Loading(id='loading_1', type='default',
+                            children = dcc.Graph(id='graph_mapbox')),
+
+                ## compact figure, decoded in the browser, and the traces in it
+                dcc.Store(id='store_map_figure'),
+                dcc.Store(id='store_map_traces'),
+                dcc.Interval(id='interval_map_job', interval=job_poll_interval, disabled=True),
+
+                ## all trees for client mode
+                dcc.Store(id='store_client_data'),
+
+                ## species filter with type-ahead search, the options are
+                ## found on the server, see update_species_options(). Not
+                ## in client mode
                 html.Div([
+                    html.H3('Species'),
+                    dcc.Dropdown(id='dropdown_species', multi=True, placeholder='All species, type to search'),
+                ], style={'display': 'none'} if client_mode else None),
+
+                html.Div([ # column
 
-                    ## Checklist for selecting health status
-                    html.H3('Health status'),
-                    dcc.Checklist(id='checklist_health',
-                                  # make checklist with total number of elements in each category like, e.g.: Good (1426)
-                                  options=make_health_status_options(df, health_status),
-                                  value=health_status),
+                    html.Div([
+
+                        ## Checklist for selecting Boroughs
+                        html.H3('Borough'),
+                        dcc.Checklist(id='checklist_borough',
+                                       # make checklist with total number of elements in each category like, e.g.: Queens (212)
+                                       options=make_borough_options(data.count_cube.counts_by('boroname'), data.borough_names) if data.df is not None else [],
+                                       value=['Brooklyn']),
+
+                    ], className='three columns'),
+
+                    html.Div([
+
+                        ## Checklist for selecting health status
+                        html.H3('Health status'),
+                        dcc.Checklist(id='checklist_health',
+                                      # make checklist with total number of elements in each category like, e.g.: Good (1426)
+                                      options=make_health_status_options(data.count_cube.counts_by('health'), data.health_status) if data.df is not None else [],
+                                      ## None until the data is there, see update_health_status_value()
+                                      value=data.health_status if data.df is not None else None),
                     
 
-                    ## storage variables wrapped in Loading(). This gives a 
-                    ## lifesign when large data sets are processed 
-                    html.Br(),
-                    html.Br(),
+                        ## storage variables wrapped in Loading(). This gives a 
+                        ## lifesign when large data sets are processed 
+                        html.Br(),
+                        html.Br(),
 
-                    dcc.Loading(id='loading_2', type='default',
-                            children=[
-                                dcc.Store(id='store_df_filtered'),
-                                dcc.Store(id='store_df_filtered_borough'),
-                                dcc.Store(id='store_df_filtered_health'),
-                                dcc.Store(id='store_df_graph_select'),]),
+                        dcc.Loading(id='loading_2', type='default',
+                                children=[
+                                    dcc.Store(id='store_df_filtered'),
+                                    dcc.Store(id='store_map_view',
+                                              data={'zoom': map_zoom, 'level': zoom_level(map_zoom)}),
+                                    dcc.Store(id='store_selection_geometry'),
+                                    dcc.Store(id='store_df_graph_select'),]),
 
                     
-                ], className='three columns'),
+                    ], className='three columns'),
 
-                html.Div([
+                    html.Div([
+
+                        ## Export section
+                        html.H3('Export data'),
 
-                    ## Export section
-                    html.H3('Export data'),
+                        ## the buttons start export jobs, see start_export()
+                        ## and update_export_jobs()
+                        dcc.Checklist(id='checklist_export',
+                                      options=[{'label': 'gzip compressed CSV', 'value': 'gzip'}],
+                                      value=[]),
 
-                    html.H6('Complete data set'),
+                        html.H6('Complete data set'),
                     
-                    html.Button("Download CSV", id="btn_all_csv"),
-                    dcc.Download(id="download_dataframe_all_csv"),
+                        html.Button("Download CSV", id="btn_all_csv"),
                     
-                    html.Button("Download XLSX", id="btn_all_xlsx"),
-                    dcc.Download(id="download_dataframe_all_xlsx"),
+                        html.Button("Download XLSX", id="btn_all_xlsx"),
 
-                    html.Br(),
-                    html.Br(),
+                        html.Br(),
+                        html.Br(),
 
-                    html.H6('Filtered data set'),
+                        html.H6('Filtered data set'),
                     
-                    html.Button("Download CSV", id="btn_filtered_csv"),
-                    dcc.Download(id="download_dataframe_filtered_csv"),
+                        html.Button("Download CSV", id="btn_filtered_csv"),
                     
-                    html.Button("Download XLSX", id="btn_filtered_xlsx"),
-                    dcc.Download(id="download_dataframe_filtered_xlsx"),
+                        html.Button("Download XLSX", id="btn_filtered_xlsx"),
                     
-                    html.Br(),
-                    html.Br(),
+                        html.Br(),
+                        html.Br(),
 
-                    html.H6('User selected (graphical selection)'),
+                        html.H6('User selected (graphical selection)'),
+
+                        html.Div(id='text_graph_select'),
                     
-                    html.Button("Download CSV", id="btn_graph_select_csv"),
-                    dcc.Download(id="download_dataframe_graph_select_csv"),
+                        html.Button("Download CSV", id="btn_graph_select_csv"),
                     
-                    html.Button("Download XLSX", id="btn_graph_select_xlsx"),
-                    dcc.Download(id="download_dataframe_graph_select_xlsx"),
+                        html.Button("Download XLSX", id="btn_graph_select_xlsx"),
+
+                        ## progress of the export jobs and download links
+                        html.Div(id='text_export_jobs'),
+                        dcc.Store(id='store_export_jobs', data=[]),
+                        dcc.Interval(id='interval_jobs', interval=job_poll_interval, disabled=True),
                     
-                ], className='six columns'),
+                    ], className='six columns'),
 
-            ], className='column'),
+                ], className='column'),
 
-        ], className='eight columns'),
+            ], className='eight columns'),
 
-        html.Div([ # second sub column, width 3 for table on right side
+            html.Div([ # second sub column, width 3 for table on right side
 
-            ## Table showing details of selected item
-            html.H3('Selected tree'),
+                ## Table showing details of selected item
+                html.H3('Selected tree'),
             
-            dash_table.DataTable(
-                id='selectedTreeTable',
-                columns=[{'name': 'Trait', 'id': 'Trait'},
-                         {'name': 'Value', 'id': 'Value'}],
-                ),
+                dash_table.DataTable(
+                    id='selectedTreeTable',
+                    columns=[{'name': 'Trait', 'id': 'Trait'},
+                             {'name': 'Value', 'id': 'Value'}],
+                    ),
+
+            ], className='three columns'),
+
+        ], className='row'),
+
+        html.Div([ # statistics row
 
-        ], className='three columns'),
+            html.Div([
 
-    ], className='row'),
+                ## statistics of the filtered trees by district or species
+                html.H3('Statistics'),
+                dcc.RadioItems(id='radio_stats_dimension',
+                               options=make_stats_dimension_options(data),
+                               value='boroname',
+                               labelStyle={'display': 'inline-block', 'margin-right': '1em'}),
+                dcc.RadioItems(id='radio_stats_measure',
+                               options=[{'label': val, 'value': val} for val in stats_measures],
+                               value='% Dead',
+                               labelStyle={'display': 'inline-block', 'margin-right': '1em'}),
 
-    # ## only for testing and debugging
-    # html.Div('TEST', id='test_text'),
+                dcc.Graph(id='graph_stats'),
 
-])
+            ], className='six columns'),
+
+            html.Div([
+
+                dash_table.DataTable(
+                    id='table_stats',
+                    sort_action='native',
+                    page_size=20,
+                    ),
+                dcc.Interval(id='interval_stats_job', interval=job_poll_interval, disabled=True),
+
+            ], className='five columns'),
+
+        ], className='row'),
+
+        # ## only for testing and debugging
+        # html.Div('TEST', id='test_text'),
+
+    ])
+
+
+app.layout = serve_layout
 
 
                  
@@ -349,157 +2382,499 @@ app.layout = html.Div([
     
 
 
-## update filtered data
-@app.callback(dash.dependencies.Output('store_df_filtered', 'data'),
-              dash.dependencies.Output('store_df_filtered_borough', 'data'),
-              dash.dependencies.Output('store_df_filtered_health', 'data'),
-              dash.dependencies.Input('checklist_borough', 'value'),
-              dash.dependencies.Input('checklist_health', 'value'),
-              prevent_initial_call=False,)
-def update_filtered_data(borough_name, health_status):
-    
-    df_filtered_borough = df.loc[df['boroname'].isin(borough_name)]
-    df_filtered_health = df.loc[df['health'].isin(health_status)]
-    
-    df_filtered = df_filtered_borough.loc[df['health'].isin(health_status)]
-    
-    return df_filtered.to_json(date_format='iso', orient='split'), \
-           df_filtered_borough.to_json(date_format='iso', orient='split'), \
-           df_filtered_health.to_json(date_format='iso', orient='split')
+## show the loading progress, data_version tells the other callbacks when
+## (more) data has arrived
+@app.callback(dash.dependencies.Output('text_load', 'children'),
+              dash.dependencies.Output('interval_load', 'disabled'),
+              dash.dependencies.Output('store_data_version', 'data'),
+              dash.dependencies.Input('interval_load', 'n_intervals'),
+              dash.dependencies.State('store_data_version', 'data'),
+              prevent_initial_call=True,)
+def update_load_progress(n_intervals, version):
+    data = tree_data
+    return (load_text(), load_state['status'] != 'loading',
+            data.version if data.version != version else dash.no_update)
+
+
+## select all health status once the data is there
+@app.callback(dash.dependencies.Output('checklist_health', 'value'),
+              dash.dependencies.Input('store_data_version', 'data'),
+              dash.dependencies.State('checklist_health', 'value'),
+              prevent_initial_call=True,)
+def update_health_status_value(version, value):
+    data = tree_data
+    if value is not None or data.df is None:
+        raise dash.exceptions.PreventUpdate
+    return data.health_status
 
 
-## update mapbox figure
-@app.callback(dash.dependencies.Output('graph_mapbox', 'figure'),
-              dash.dependencies.Input('store_df_filtered', 'data'),
+## statistics dimensions of the loaded data
+@app.callback(dash.dependencies.Output('radio_stats_dimension', 'options'),
+              dash.dependencies.Input('store_data_version', 'data'),
               prevent_initial_call=True,)
-def update_graph_mapbox(jsonified_filtered_data):
-    df_filtered = pd.read_json(jsonified_filtered_data, orient='split')
-    return create_mapbox_figure(df_filtered)
+def update_stats_dimension_options(version):
+    return make_stats_dimension_options(tree_data)
 
 
-## update checklist_borough
-@app.callback(dash.dependencies.Output('checklist_borough', 'options'),
-              dash.dependencies.Input('store_df_filtered_health', 'data'))
-def update_borough_options(jsonified_filtered_data):
-    df_filtered = pd.read_json(jsonified_filtered_data, orient='split')
-    options = make_borough_options(df_filtered, borough_names)
+## update filtered data
+@callback_if(not client_mode,
+             dash.dependencies.Output('store_df_filtered', 'data'),
+             dash.dependencies.Input('checklist_borough', 'value'),
+             dash.dependencies.Input('checklist_health', 'value'),
+             dash.dependencies.Input('store_data_version', 'data'),
+             dash.dependencies.Input('dropdown_species', 'value'),
+             prevent_initial_call=False,)
+def update_filtered_data(borough_name, health_status, version=None, species=None):
+
+    ## filtered data stays in filter_cache, the stores only get the key
+    data = tree_data
+    filter_state = make_filter_state(borough_name, health_status, species)
+    if data.df is not None:
+        resolve_filter(data, filter_state)
+
+    return filter_state
+
+
+## remember zoom and visible part of the map. Only changes of the level of
+## detail are passed on to the map, and when zoomed in, moves beyond the
+## margin around the trees which are already shown
+@callback_if(not client_mode,
+             dash.dependencies.Output('store_map_view', 'data'),
+             dash.dependencies.Input('graph_mapbox', 'relayoutData'),
+             dash.dependencies.State('store_map_view', 'data'),
+             prevent_initial_call=True,)
+def update_map_view(relayout_data, map_view):
+
+    if not relayout_data or not ('mapbox.zoom' in relayout_data or 'mapbox._derived' in relayout_data):
+        raise dash.exceptions.PreventUpdate
+
+    zoom = relayout_data.get('mapbox.zoom', map_view['zoom'])
+    level = zoom_level(zoom)
+
+    if level != 'points':
+        if level == map_view['level']:
+            raise dash.exceptions.PreventUpdate
+        return {'zoom': zoom, 'level': level}
+
+    bounds = view_bounds(relayout_data, zoom)
+    if level == map_view['level'] and map_view.get('bounds') and contains(map_view['bounds'], bounds):
+        raise dash.exceptions.PreventUpdate
+
+    return {'zoom': zoom, 'level': level, 'bounds': add_margin(bounds, view_margin)}
+
+
+## update mapbox figure: all trees if there are only a few, the trees in
+## view when zoomed in, aggregated grid cells otherwise. In density mode only
+## the density grid of the filtered trees. store_map_traces describes the
+## figure in the browser: if single trees of the same map section are shown
+## before and after, only the traces of added or removed boroughs and health
+## status are sent. While the density job runs, the aggregated trees are shown
+## and the job is polled with interval_map_job
+@callback_if(not client_mode,
+             dash.dependencies.Output('store_map_figure', 'data'),
+             dash.dependencies.Output('store_map_traces', 'data'),
+             dash.dependencies.Output('interval_map_job', 'disabled'),
+             dash.dependencies.Input('store_df_filtered', 'data'),
+             dash.dependencies.Input('store_map_view', 'data'),
+             dash.dependencies.Input('radio_map_mode', 'value'),
+             dash.dependencies.Input('interval_map_job', 'n_intervals'),
+             dash.dependencies.State('store_map_traces', 'data'),
+             prevent_initial_call=True,)
+def update_graph_mapbox(filter_state, map_view, map_mode='trees', n_intervals=None, map_traces=None):
+
+    data = tree_data
+    if data.df is None:
+        return create_mapbox_figure(pd.DataFrame(columns=['latitude', 'longitude', 'spc_common'])), None, True
+
+    if map_mode == 'density':
+        level = 0 if map_view['level'] == 'points' else map_view['level']
+        key, density = resolve_density(data, filter_state, level)
+        if density is not None:
+            return create_density_figure(*density, map_view['zoom']), None, True
+        if map_traces and map_traces.get('job') == key:
+            return dash.no_update, dash.no_update, False
+        return create_grid_figure(aggregate_trees(data, filter_state, map_view)), {'job': key}, False
+
+    figure, state = tree_figure(data, filter_state, map_view, map_traces)
+    return figure, state, True
+
+
+def aggregate_trees(data, filter_state, map_view):
+    ## tree counts in grid cells for the zoomed out map
+    level = 0 if map_view['level'] == 'points' else map_view['level']
+    filtered = resolve_filter(data, filter_state)['filtered'] if filter_state.get('species') else None
+    return data.grid_bins.aggregate(level, filter_selections(filter_state), max_markers, filtered)
+
+
+def tree_figure(data, filter_state, map_view, map_traces):
+
+    filtered = resolve_filter(data, filter_state)
+
+    ## single trees: all filtered trees (bounds None) or, zoomed in, the
+    ## filtered trees in the map section
+    trees, bounds = None, None
+    if len(filtered['filtered']) <= max_markers:
+        trees = filtered['filtered']
+    elif map_view['level'] == 'points':
+        positions = data.spatial_index.query(*map_view['bounds'])
+        positions = positions[filtered['mask'][positions]]
+        if len(positions) <= max_points:
+            trees, bounds = data.df.iloc[positions], list(map_view['bounds'])
+
+    if trees is not None:
+        ## the traces are per borough and health status, other data, species
+        ## or another map section need a new figure
+        slices = tree_slices(trees)
+        species = filter_state.get('species', [])
+        if (not map_traces or map_traces.get('version') != data.version or map_traces.get('species') != species
+                or map_traces.get('bounds') != bounds or len(slices) == 0):
+            state = {'version': data.version, 'species': species, 'bounds': bounds,
+                     'traces': [uid for uid, _, _, _ in slices]}
+            return create_mapbox_figure(trees), state
+        return update_tree_traces(trees, slices, map_traces)
+
+    return create_grid_figure(aggregate_trees(data, filter_state, map_view)), None
+
+
+def update_tree_traces(filtered, slices, map_traces):
+
+    ## partial update of the figure in the browser with the traces shown:
+    ## remove the traces which are not needed anymore, append the new ones
+    shown = map_traces['traces']
+    wanted = {uid for uid, _, _, _ in slices}
+    removed = [idx for idx, uid in enumerate(shown) if uid not in wanted]
+    added = [(uid, borough, val, positions) for uid, borough, val, positions in slices if uid not in shown]
+    if not removed and not added:
+        return dash.no_update, dash.no_update
+
+    patch = dash.Patch()
+    for idx in reversed(removed):
+        del patch['data'][idx]
+    for uid, borough, val, positions in added:
+        patch['data'].append(create_tree_trace(filtered.iloc[positions], borough, val))
+
+    traces = [uid for uid in shown if uid in wanted] + [uid for uid, _, _, _ in added]
+    return patch, dict(map_traces, traces=traces)
+
+
+## decode the typed arrays of the figure ({dtype, bdata}, see encode_array)
+## to javascript typed arrays. The traces left unchanged by a patch are
+## reused, not decoded again
+if not client_mode:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='trees', function_name='decode_figure'),
+        dash.dependencies.Output('graph_mapbox', 'figure'),
+        dash.dependencies.Input('store_map_figure', 'data'))
+
+
+## client mode: filter, checklist labels, map and statistics in the browser
+if client_mode:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='trees', function_name='filter_trees'),
+        dash.dependencies.Output('store_df_filtered', 'data'),
+        dash.dependencies.Output('graph_mapbox', 'figure'),
+        dash.dependencies.Output('checklist_borough', 'options'),
+        dash.dependencies.Output('checklist_health', 'options'),
+        dash.dependencies.Input('checklist_borough', 'value'),
+        dash.dependencies.Input('checklist_health', 'value'),
+        dash.dependencies.Input('store_client_data', 'data'))
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='trees', function_name='statistics'),
+        dash.dependencies.Output('table_stats', 'columns'),
+        dash.dependencies.Output('table_stats', 'data'),
+        dash.dependencies.Output('graph_stats', 'figure'),
+        dash.dependencies.Input('store_df_filtered', 'data'),
+        dash.dependencies.Input('radio_stats_dimension', 'value'),
+        dash.dependencies.Input('radio_stats_measure', 'value'),
+        dash.dependencies.State('store_client_data', 'data'))
+
+
+## compact data for client mode, sent once for each data_version
+@callback_if(client_mode,
+             dash.dependencies.Output('store_client_data', 'data'),
+             dash.dependencies.Input('store_data_version', 'data'))
+def update_client_data(version):
+    data = tree_data
+    if data.df is None:
+        raise dash.exceptions.PreventUpdate
+    return client_data_cache.get(data.version, lambda: make_client_data(data))
+
+
+## details of a single tree when hovering, the figure has no hover texts
+@app.callback(dash.dependencies.Output('text_hover', 'children'),
+              dash.dependencies.Input('graph_mapbox', 'hoverData'),
+              prevent_initial_call=True,)
+def update_hover_text(hover_data):
+
+    if not hover_data or not isinstance(hover_data['points'][0].get('customdata'), int):
+        return None
+
+    tree_id = hover_data['points'][0]['customdata']
+    record = {val['Trait']: val['Value'] for val in get_tree_records(tree_data, [tree_id]).get(tree_id, [])}
+    if not record:
+        return None
+
+    return '{} ({}): {}, diameter {} in, problems: {}, tree_id {}'.format(
+        record.get('spc_common'), record.get('spc_latin'), record.get('health'),
+        record.get('tree_dbh'), record.get('problems'), tree_id)
+
+
+## update checklist_borough, counts given the health status selection
+@callback_if(not client_mode,
+             dash.dependencies.Output('checklist_borough', 'options'),
+             dash.dependencies.Input('store_df_filtered', 'data'))
+def update_borough_options(filter_state):
+    data = tree_data
+    if data.df is None:
+        return []
+    counts = data.count_cube.counts_by('boroname', filter_selections(filter_state))
+    options = make_borough_options(counts, data.borough_names)
     return options
 
-## update checklist_health
-@app.callback(dash.dependencies.Output('checklist_health', 'options'),
-              dash.dependencies.Input('store_df_filtered_borough', 'data'))
-def update_health_status_options(jsonified_filtered_data):
-    df_filtered = pd.read_json(jsonified_filtered_data, orient='split')
-    options = make_health_status_options(df_filtered, health_status)
+## update checklist_health, counts given the borough selection
+@callback_if(not client_mode,
+             dash.dependencies.Output('checklist_health', 'options'),
+             dash.dependencies.Input('store_df_filtered', 'data'))
+def update_health_status_options(filter_state):
+    data = tree_data
+    if data.df is None:
+        return []
+    counts = data.count_cube.counts_by('health', filter_selections(filter_state))
+    options = make_health_status_options(counts, data.health_status)
     return options
 
 
-## save user selected tree_ids
-@app.callback(dash.dependencies.Output('store_df_graph_select', 'data'),
-              dash.dependencies.Input('graph_mapbox', 'selectedData'))
-def update_user_selected_data(selected_data):
-    if selected_data:
-        tree_ids = [val['customdata'][-1] for val in selected_data['points'] ]
-        return tree_ids
-    return None
+## species matching the text typed into the dropdown. Selected species stay
+## in the options
+@callback_if(not client_mode,
+             dash.dependencies.Output('dropdown_species', 'options'),
+             dash.dependencies.Input('dropdown_species', 'search_value'),
+             dash.dependencies.Input('store_data_version', 'data'),
+             dash.dependencies.State('dropdown_species', 'value'))
+def update_species_options(search_value, version, value):
+    data = tree_data
+    if data.df is None:
+        return []
+    value = value or []
+    names = value + [name for name in data.species_index.search(search_value or '', species_search_limit)
+                     if name not in value]
+    return make_species_options(names, data.species_index)
+
+
+## statistics table and bar chart for the current filter. In client mode
+## they are computed in the browser from the cubes in the client data
+@callback_if(not client_mode,
+             dash.dependencies.Output('table_stats', 'columns'),
+             dash.dependencies.Output('table_stats', 'data'),
+             dash.dependencies.Output('graph_stats', 'figure'),
+             dash.dependencies.Output('interval_stats_job', 'disabled'),
+             dash.dependencies.Input('store_df_filtered', 'data'),
+             dash.dependencies.Input('radio_stats_dimension', 'value'),
+             dash.dependencies.Input('radio_stats_measure', 'value'),
+             dash.dependencies.Input('interval_stats_job', 'n_intervals'))
+def update_statistics(filter_state, dimension, measure, n_intervals=None):
+
+    data = tree_data
+    if data.df is None or not filter_state or dimension not in data.stats_cube.cubes:
+        return [], [], go.Figure(), True
+
+    ## the statistics cube is sliced in a few milliseconds, only the trees of
+    ## a species selection are aggregated by a job, polled with
+    ## interval_stats_job
+    name = [key for key, val in stats_dimensions.items() if val == dimension][0]
+    if filter_state.get('species'):
+        stats = job_queue.poll(job_queue.submit('statistics', {'dimension': dimension, 'filter_state': filter_state}))
+        if stats is None:
+            fig = go.Figure(layout=dict(title='Computing statistics…', height=300))
+            return [], [], fig, False
+    else:
+        stats = data.stats_cube.statistics(dimension, filter_selections(filter_state))
 
+    columns = [{'name': name, 'id': name}] + [{'name': val, 'id': val} for val in stats.columns]
+    records = stats.rename_axis(name).reset_index().to_dict('records')
 
-########################
-## data export functions
-########################
+    ## highest values, ratios of very small groups are left out
+    ranked = stats if measure == 'Trees' else stats[stats['Trees'] >= stats_min_trees]
+    ranked = ranked[measure].dropna().nlargest(stats_bar_count)[::-1]
 
-## all data - csv
-@app.callback(dash.dependencies.Output("download_dataframe_all_csv", "data"),
-              dash.dependencies.Input("btn_all_csv", "n_clicks"),
-              prevent_initial_call=True,)
-def download_all_csv(n_clicks):
-    df_download = df.drop(columns = ['tree_dbh_vis'])
-    return dcc.send_data_frame(df_download.to_csv, "StreetTreesOfNYC.csv")
+    return columns, records, create_stats_figure(ranked, measure), True
 
-## all data - excel
-@app.callback(dash.dependencies.Output("download_dataframe_all_xlsx", "data"),
-              dash.dependencies.Input("btn_all_xlsx", "n_clicks"),
-              prevent_initial_call=True,)
-def download_all_xlsx(n_clicks):
-    df_download = df.drop(columns = ['tree_dbh_vis'])
-    return dcc.send_data_frame(df_download.to_excel, "StreetTreesOfNYC.xlsx", sheet_name="Sheet_1")
-
-## filtered data - csv
-@app.callback(dash.dependencies.Output("download_dataframe_filtered_csv", "data"),
-              dash.dependencies.Input("btn_filtered_csv", "n_clicks"),
-              dash.dependencies.Input('store_df_filtered', 'data'),
-              prevent_initial_call=True,)
-def download_filtered_csv(n_clicks, jsonified_filtered_data):
-    
-    ## make sure that the button was clicked (we ignore the trigger event from altered data)
-    changed_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
-    
-    if 'btn_filtered_csv' in changed_id:
-        df_filter = pd.read_json(jsonified_filtered_data, orient='split')
-        df_filter = df_filter.drop(columns = ['tree_dbh_vis'])
-    
-        return dcc.send_data_frame(df_filter.to_csv, "StreetTreesOfNYC_filtered.csv")
-    
-    return
 
-## filtered data - excel
-@app.callback(dash.dependencies.Output("download_dataframe_filtered_xlsx", "data"),
-              dash.dependencies.Input("btn_filtered_xlsx", "n_clicks"),
-              dash.dependencies.Input('store_df_filtered', 'data'),
-              prevent_initial_call=True,)
-def download_filtered_xlsx(n_clicks, jsonified_filtered_data):
-    
-    ## make sure that the button was clicked (we ignore the trigger event from altered data)
-    changed_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
-    
-    if 'btn_filtered_xlsx' in changed_id:
-        df_filter = pd.read_json(jsonified_filtered_data, orient='split')
-        df_filter = df_filter.drop(columns = ['tree_dbh_vis'])
-    
-        return dcc.send_data_frame(df_filter.to_excel, "StreetTreesOfNYC_filtered.xlsx", sheet_name="Sheet_1")
-    
-    return
+def create_stats_figure(ranked, measure):
+    ## bar chart of the ranked values of measure, the layout is used by
+    ## the statistics in client mode as well
+    fig = go.Figure(go.Bar(x=ranked.to_numpy(), y=ranked.index, orientation='h'))
+    fig.update_layout(xaxis_title=measure,
+                      height=max(300, 20 * len(ranked) + 100),
+                      margin=dict(t=30, b=40, l=0, r=0))
+    fig.update_yaxes(automargin=True, type='category')
+    return fig
 
 
-## graph selected data - csv
-@app.callback(dash.dependencies.Output("download_dataframe_graph_select_csv", "data"),
-              dash.dependencies.Input("btn_graph_select_csv", "n_clicks"),
-              dash.dependencies.Input('store_df_graph_select', 'data'),
-              prevent_initial_call=True,)
-def download_graph_select_csv(n_clicks, tree_ids):
-    
-    ## make sure that the button was clicked (we ignore the trigger event from altered data)
-    changed_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
-    
-    if 'btn_graph_select_csv' in changed_id and tree_ids:
-        
-        df_filter = df[df['tree_id'].isin(tree_ids)]
-        
-        df_filter = df_filter.drop(columns = ['tree_dbh_vis'])
-    
-        return dcc.send_data_frame(df_filter.to_csv, "StreetTreesOfNYC_graph_select.csv")
-    
-    return
+## only the geometry of a selection is sent to the server, not the points
+app.clientside_callback(
+    """
+    function(selected_data) {
+        if (!selected_data) {
+            return null;
+        }
+        return {range: selected_data.range, lassoPoints: selected_data.lassoPoints};
+    }
+    """,
+    dash.dependencies.Output('store_selection_geometry', 'data'),
+    dash.dependencies.Input('graph_mapbox', 'selectedData'))
+
+
+## select the trees in the selected area on the server, the store gets the
+## selection without the positions
+@app.callback(dash.dependencies.Output('store_df_graph_select', 'data'),
+              dash.dependencies.Output('text_graph_select', 'children'),
+              dash.dependencies.Input('store_selection_geometry', 'data'),
+              dash.dependencies.State('store_df_filtered', 'data'))
+def update_user_selected_data(geometry, filter_state):
+    data = tree_data
+    if geometry and filter_state and data.df is not None:
+        selection = make_selection(geometry, filter_state)
+        positions = resolve_selection(data, selection)
+        return dict(selection, count=len(positions)), '{} trees selected'.format(len(positions))
+    return None, 'No trees selected'
+
+
+########################
+## data export functions
+########################
 
-## graph selected data - excel
-@app.callback(dash.dependencies.Output("download_dataframe_graph_select_xlsx", "data"),
-              dash.dependencies.Input("btn_graph_select_xlsx", "n_clicks"),
-              dash.dependencies.Input('store_df_graph_select', 'data'),
+## exports are served by Flask routes for direct links. CSV is streamed in
+## chunks, XLSX is written by a job: the file is sent when the job is done,
+## else 202 Accepted points to /jobs/<key> to poll. scope: all, filtered or
+## graph_select, fmt: csv or xlsx
+@app.server.route('/export/<any(all, filtered, graph_select):scope>.<any(csv, xlsx):fmt>')
+def export_data(scope, fmt):
+
+    data = tree_data
+    if data.df is None:
+        flask.abort(503, 'The data is still loading, please try again later')
+
+    args = flask.request.args
+    compress = fmt == 'csv' and args.get('gzip') == '1'
+    filter_state = make_filter_state(args.getlist('borough'), args.getlist('health'), args.getlist('species'))
+    selection = None
+    if scope == 'graph_select':
+        ## the geometry of the selection as JSON, see export_url
+        try:
+            geometry = json.loads(args.get('selection', ''))
+        except ValueError:
+            geometry = None
+        if not isinstance(geometry, dict):
+            flask.abort(400, 'The selection is missing or invalid')
+        selection = make_selection(geometry, filter_state)
+    positions = export_positions(data, scope, filter_state, selection)
+
+    if fmt == 'xlsx':
+        params, job_data = export_job_params(scope, fmt, compress, filter_state, selection, positions)
+        return job_result(job_queue.submit('export', params, job_data))
+
+    filename = export_filename(scope, fmt, compress)
+    body = stream_csv(export_chunks(data, positions), compress)
+    return flask.Response(body, mimetype=export_mimetype(fmt, compress), headers={
+        'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
+
+def export_job_params(scope, fmt, compress, filter_state, selection, positions):
+    ## parameters of an export job, the positions of a selection are passed
+    ## along, the key of the selection stands for them
+    params = {'scope': scope, 'fmt': fmt, 'compress': compress}
+    if scope == 'filtered':
+        params['filter_state'] = filter_state
+    if scope == 'graph_select':
+        params['selection'] = selection['key']
+        return params, {'positions': positions}
+    return params, None
+
+
+## the export buttons start a job for the current filter or selection. Jobs
+## for the same export are shared
+@app.callback(dash.dependencies.Output('store_export_jobs', 'data'),
+              dash.dependencies.Input('btn_all_csv', 'n_clicks'),
+              dash.dependencies.Input('btn_all_xlsx', 'n_clicks'),
+              dash.dependencies.Input('btn_filtered_csv', 'n_clicks'),
+              dash.dependencies.Input('btn_filtered_xlsx', 'n_clicks'),
+              dash.dependencies.Input('btn_graph_select_csv', 'n_clicks'),
+              dash.dependencies.Input('btn_graph_select_xlsx', 'n_clicks'),
+              dash.dependencies.State('store_df_filtered', 'data'),
+              dash.dependencies.State('store_df_graph_select', 'data'),
+              dash.dependencies.State('checklist_export', 'value'),
+              dash.dependencies.State('store_export_jobs', 'data'),
               prevent_initial_call=True,)
-def download_graph_select_xlsx(n_clicks, tree_ids):
-    
-    ## make sure that the button was clicked (we ignore the trigger event from altered data)
-    changed_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
-    
-    if 'btn_graph_select_xlsx' in changed_id and tree_ids:
-         
-        df_filter = df[df['tree_id'].isin(tree_ids)]
-        
-        df_filter = df_filter.drop(columns = ['tree_dbh_vis'])
-    
-        return dcc.send_data_frame(df_filter.to_excel, "StreetTreesOfNYC_graph_select.xlsx", sheet_name="Sheet_1")
-    
-    return
+def start_export(all_csv, all_xlsx, filtered_csv, filtered_xlsx, select_csv, select_xlsx,
+                 filter_state, selection, export_options, jobs):
+
+    if load_state['status'] != 'ready' or not dash.ctx.triggered_id:
+        raise dash.exceptions.PreventUpdate
+
+    data = tree_data
+    scope, fmt = dash.ctx.triggered_id[len('btn_'):].rsplit('_', 1)
+    compress = fmt == 'csv' and 'gzip' in (export_options or [])
+    positions = None
+    if scope == 'graph_select':
+        if not selection:
+            raise dash.exceptions.PreventUpdate
+        positions = export_positions(data, scope, selection=selection)
+        if len(positions) == 0:
+            raise dash.exceptions.PreventUpdate
+
+    params, job_data = export_job_params(scope, fmt, compress, filter_state, selection, positions)
+    key = job_queue.submit('export', params, job_data)
+
+    jobs = [job for job in jobs or [] if job['key'] != key]
+    return jobs + [{'key': key, 'name': export_filename(scope, fmt, compress)}]
+
+
+## progress of the export jobs, download links when they are done
+@app.callback(dash.dependencies.Output('text_export_jobs', 'children'),
+              dash.dependencies.Output('interval_jobs', 'disabled'),
+              dash.dependencies.Input('store_export_jobs', 'data'),
+              dash.dependencies.Input('interval_jobs', 'n_intervals'),)
+def update_export_jobs(jobs, n_intervals):
+
+    items, running = [], False
+    for job in jobs or []:
+        status = job_queue.status(job['key'])
+        if status['state'] == 'done':
+            items.append(html.Div(html.A('Download ' + job['name'], download=job['name'],
+                                         href=app.get_relative_path('/jobs/' + job['key']))))
+        elif status['state'] == 'failed':
+            items.append(html.Div('{}: failed, {}'.format(job['name'], status['error'])))
+        elif status['state'] == 'unknown':
+            items.append(html.Div('{}: expired, please export again'.format(job['name'])))
+        else:
+            running = True
+            items.append(html.Div('{}: {} {:.0%}'.format(job['name'], status['state'], status['progress'])))
+
+    return items, not running
+
+
+## result files of export jobs. While the job is queued or running, 202
+## Accepted with the progress, poll again after Retry-After seconds
+@app.server.route('/jobs/<key>')
+def job_result(key):
+    if not key.isalnum() or job_queue.status(key)['state'] == 'unknown':
+        flask.abort(404, 'Export not found, please export again')
+    try:
+        result = job_queue.poll(key)
+    except RuntimeError as e:
+        flask.abort(500, str(e))
+    if result is None:
+        status = job_queue.status(key)
+        response = flask.jsonify(job=key, state=status['state'], progress=status['progress'])
+        response.status_code = 202
+        response.headers['Location'] = app.get_relative_path('/jobs/' + key)
+        response.headers['Retry-After'] = str(max(1, round(job_poll_interval / 1000)))
+        return response
+    if not isinstance(result, dict) or 'file' not in result:
+        flask.abort(404, 'Export not found, please export again')
+    return flask.send_file(os.path.join(job_queue.path, key, result['file']), mimetype=result['mimetype'],
+                           as_attachment=True, download_name=result['file'])
 
 
 
@@ -509,33 +2884,86 @@ def download_graph_select_xlsx(n_clicks, tree_ids):
 def get_single_tree_data(selected_value):
 
     ## selected_value has the following exemplary structure:
-    ## {'points': [{'curveNumber': 4, 'pointNumber': 554, 'pointIndex': 554, 'lon': -73.94091248, 'lat': 40.71911554, 'hovertext': 'Stump', 'marker.size': 5, 'customdata': ['nan', 'Stump', 'nan', 0, 5, 40.71911554, -73.94091248, '221731']}]}
-    ## we are just interested in the tree_id which is the last value of
-    ## 'customdata'
-    if selected_value:
-        tree_id = selected_value['points'][0]['customdata'][-1]
+    ## {'points': [{'curveNumber': 4, 'pointNumber': 554, 'pointIndex': 554, 'lon': -73.94091248, 'lat': 40.71911554, 'marker.size': 5, 'customdata': 221731}]}
+    ## we are just interested in the tree_id in 'customdata' (the last value
+    ## if it is a list)
+    if selected_value and 'customdata' in selected_value['points'][0]:
+        tree_id = selected_value['points'][0]['customdata']
+        if isinstance(tree_id, list):
+            tree_id = tree_id[-1]
 
         ## get complete entry for tree_id
-        value = df.loc[df.tree_id == tree_id]
+        return get_tree_records(tree_data, [tree_id]).get(tree_id)
 
-        ## remove tree_dbh_vis
-        value = value.drop(columns = ['tree_dbh_vis'])
+    return None
 
-        ## Transpose 
-        value = value.T
 
-        ## copy original row names into a new column
-        value['Trait'] = value.index
-        
-        ## create new column names
-        value.columns = ['Value', 'Trait']
-        
-        # convert dataframe into dict which can be fed into DataTable
-        data = value.to_dict('records')
 
-        return data
+##########################
+## tree API for other tools
+##########################
 
-    return None
+## all data for a single tree, same records as in selectedTreeTable
+@app.server.route('/api/trees/<int:tree_id>')
+def api_tree(tree_id):
+    if load_state['status'] != 'ready':
+        return json_response({'error': 'The data is still loading'}, 503)
+    records = get_tree_records(tree_data, [tree_id])
+    if tree_id not in records:
+        return json_response({'error': 'Unknown tree_id {}'.format(tree_id)}, 404)
+    return json_response(records[tree_id])
+
+
+## data for many trees, POST {"tree_ids": [...]}
+@app.server.route('/api/trees', methods=['POST'])
+def api_trees():
+    if load_state['status'] != 'ready':
+        return json_response({'error': 'The data is still loading'}, 503)
+    ## JSON true and false are ints in python, they aren't tree_ids
+    request = flask.request.get_json(silent=True)
+    tree_ids = request.get('tree_ids') if isinstance(request, dict) else None
+    if not isinstance(tree_ids, list) or not all(isinstance(val, int) and not isinstance(val, bool)
+                                                 for val in tree_ids):
+        return json_response({'error': 'Expected {"tree_ids": [...]} with integer ids'}, 400)
+    if len(tree_ids) > max_batch_trees:
+        return json_response({'error': 'At most {} trees per request'.format(max_batch_trees)}, 400)
+
+    records = get_tree_records(tree_data, tree_ids)
+    return json_response({'trees': {str(key): val for key, val in records.items()},
+                          'missing': [val for val in tree_ids if val not in records]})
+
+
+## progress of loading the data, e.g. for readiness checks: 503 until loaded
+@app.server.route('/api/status')
+def api_status():
+    data = tree_data
+    return json_response(dict(load_state, trees=data.df_count, data_version=data.version),
+                         200 if load_state['status'] == 'ready' else 503)
+
+
+##########################
+## metrics
+##########################
+
+## request and response size of each callback
+@app.server.after_request
+def record_payload_size(response):
+    name = flask.g.get('callback_name')
+    if name is not None and not response.direct_passthrough:
+        labels = {'callback': name}
+        metrics.observe('trees_callback_request_bytes', labels,
+                        flask.request.content_length or 0, Metrics.size_buckets)
+        metrics.observe('trees_callback_response_bytes', labels,
+                        response.calculate_content_length() or 0, Metrics.size_buckets)
+    return response
+
+
+@app.server.route('/metrics')
+def metrics_endpoint():
+    caches = [('filter', filter_cache), ('selection', selection_cache), ('tree', tree_cache)]
+    values = ([('trees_cache_hits_total', {'cache': name}, cache.hits) for name, cache in caches] +
+              [('trees_cache_misses_total', {'cache': name}, cache.misses) for name, cache in caches])
+    return flask.Response(metrics.render(values), mimetype='text/plain; version=0.0.4')
 
 
 
@@ -556,4 +2984,6 @@ def get_single_tree_data(selected_value):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    start_loading()
     app.run_server(debug=True, host='0.0.0.0')